@@ -5,9 +5,7 @@ Handles adding 25 more properties to the database
 """
 
 import os
-from flask import Flask
-from models import db, Property
-from config import Config
+from models import Property
 
 def add_more_properties():
     """Add 25 more properties with all details"""
@@ -392,41 +390,23 @@ def add_more_properties():
         }
     ]
 
-    added_count = 0
+    new_properties = []
     for prop_data in properties_data:
-        try:
-            # Check if property already exists
-            existing_property = Property.query.filter_by(title=prop_data['title']).first()
-            if existing_property:
-                print(f"Property '{prop_data['title']}' already exists, skipping...")
-                continue
-
-            # Create property
-            property = Property(
-                title=prop_data['title'],
-                description=prop_data['description'],
-                price=prop_data['price'],
-                property_type=prop_data['property_type'],
-                location=prop_data['location'],
-                area=prop_data['area'],
-                bedrooms=prop_data['bedrooms'],
-                bathrooms=prop_data['bathrooms'],
-                down_payment=prop_data['down_payment'],
-                monthly_installment=prop_data['monthly_installment'],
-                installment_years=prop_data['installment_years'],
-                image=prop_data['image'],
-                status='available'
-            )
+        # Check if property already exists
+        existing_property = Property.get_by_title(prop_data['title'])
+        if existing_property:
+            print(f"Property '{prop_data['title']}' already exists, skipping...")
+            continue
+        new_properties.append(prop_data)
 
-            db.session.add(property)
-            db.session.commit()
-            added_count += 1
+    added_count = 0
+    try:
+        # Insert the new properties in one batched transaction
+        added_count = len(Property.create_many(new_properties))
+        for prop_data in new_properties:
             print(f"Added property: {prop_data['title']}")
-
-        except Exception as e:
-            print(f"Error adding property {prop_data['title']}: {e}")
-            db.session.rollback()
-            continue
+    except Exception as e:
+        print(f"Error adding properties: {e}")
 
     print(f"Successfully added {added_count} new properties")
     return added_count > 0
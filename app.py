@@ -1,8 +1,18 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, g, \
+    make_response
+from functools import wraps
+from datetime import timezone
+import gzip
+import hashlib
+import math
 import os
 import openai
+from cache import LRUCache, PageCache
 from config import Config
-from models import Property, ContactMessage, User, Favorite, ChatHistory
+from models import (Property, ContactMessage, User, Favorite, ChatHistory, Location, db_conn,
+                    property_cache, user_cache, session_user_cache, featured_cache, missing_property_cache,
+                    property_id_filter, similar_index, listing_index, warm_listing_index, text_index,
+                    warm_text_index, on_property_change, cache_backend)
 from forms import PropertyForm, ContactForm, LoginForm, RegisterForm, ProfileForm, UserPropertyForm
 from flask_wtf.csrf import CSRFProtect
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
@@ -25,6 +35,31 @@ def create_app():
     return app
 
 app = create_app()
+# /properties is answered by SQL until the in-memory listing and text indexes have loaded
+warm_listing_index()
+warm_text_index()
+
+# Each request borrows one pooled connection on its first query and returns it here
+@app.before_request
+def bind_db_connection():
+    db_conn.begin_request(f"{request.method} {request.path}")
+
+@app.after_request
+def add_db_debug_headers(response):
+    if app.debug or app.config.get('DB_DEBUG_HEADERS'):
+        stats = db_conn.request_stats()
+        response.headers['X-DB-Queries'] = str(stats.count)
+        response.headers['X-DB-Time-Ms'] = f"{stats.total_time * 1000:.1f}"
+        repeated = stats.repeated()
+        if repeated:
+            response.headers['X-DB-N-Plus-One'] = '; '.join(
+                f"{count}x {shape[:120]}" for shape, count in repeated
+            )
+    return response
+
+@app.teardown_request
+def release_db_connection(exception=None):
+    db_conn.end_request()
 
 # Initialize Flask-Login
 login_manager = LoginManager()
@@ -33,7 +68,221 @@ login_manager.login_view = 'login'
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.get_by_id(int(user_id))
+    return User.get_session_user(int(user_id))
+
+def current_user_id():
+    """Id of the logged-in user, or None for anonymous visitors"""
+    return current_user.id if current_user.is_authenticated else None
+
+def _amount(value):
+    """Query-string number for a filter; raises ValueError (so the filter is ignored) unless
+    it is finite and not negative"""
+    number = float(value)
+    if not math.isfinite(number) or number < 0:
+        raise ValueError(value)
+    return number
+
+# Query-string names of the listing filters, with the type each is parsed as
+LISTING_FILTERS = (('min_price', _amount), ('max_price', _amount), ('min_area', _amount),
+                   ('max_area', _amount), ('bedrooms', int), ('bathrooms', int), ('location_id', int))
+
+def listing_filters():
+    """Keyword arguments for Property.get_available from the request's query string"""
+    filters = {'property_type': request.args.get('type', ''), 'location': request.args.get('location', '')}
+    query = request.args.get('q', '').strip()
+    if query:
+        filters['q'] = query
+    for name, parse in LISTING_FILTERS:
+        value = request.args.get(name, type=parse)
+        if value is not None:
+            filters[name] = value
+    return filters
+
+def listing_link_args():
+    """Filter and sort parameters of the current listing page, for its pagination links"""
+    names = ['q', 'type', 'location', 'sort'] + [name for name, parse in LISTING_FILTERS]
+    return {name: request.args[name] for name in names if request.args.get(name)}
+
+def listing_sort():
+    """Requested listing order; a text search is ranked by relevance unless another is asked for"""
+    return request.args.get('sort') or ('relevance' if request.args.get('q', '').strip() else 'newest')
+
+# Rendered pages for anonymous visitors
+page_cache = PageCache('page', max_entries=Config.PAGE_CACHE_MAX_ENTRIES, ttl=Config.PAGE_CACHE_TTL,
+                       max_bytes=Config.PAGE_CACHE_MAX_BYTES, backend=cache_backend)
+
+def page_cache_key():
+    """Endpoint, view args and query args with empty values dropped and keys sorted"""
+    args = sorted((key, value) for key, values in request.args.lists() for value in values if value)
+    return (request.endpoint, tuple(sorted(request.view_args.items())), tuple(args))
+
+# Validators of those pages, kept until any listing changes
+validator_cache = LRUCache('validators', max_entries=Config.PAGE_CACHE_MAX_ENTRIES, ttl=Config.PAGE_CACHE_TTL,
+                           backend=cache_backend)
+
+def tag_page(*property_ids):
+    """Mark the page being rendered as showing these listings, so changing one purges it"""
+    if 'page_tags' in g:
+        g.page_tags.update(f'property:{property_id}' for property_id in property_ids)
+
+def anonymous_request():
+    """A GET from a visitor who isn't logged in and has no flashed messages waiting"""
+    return request.method in ('GET', 'HEAD') and '_user_id' not in session and not session.get('_flashes')
+
+def cached_page(*tags):
+    """Serve the view's HTML from page_cache for anonymous visitors without pending flashes"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not app.config.get('PAGE_CACHE_ENABLED') or not anonymous_request():
+                page_cache.bypassed()
+                return view(*args, **kwargs)
+
+            key = page_cache_key()
+            entry = page_cache.get(key)
+            if entry is not None:
+                body, mimetype = entry
+                if 'gzip' in request.accept_encodings:
+                    response = make_response(body)
+                    response.headers['Content-Encoding'] = 'gzip'
+                else:
+                    response = make_response(gzip.decompress(body))
+                response.mimetype = mimetype
+                response.headers['X-Page-Cache'] = 'HIT'
+                response.vary.update(('Cookie', 'Accept-Encoding'))
+                return response
+
+            g.page_tags = set(tags)
+            generation = page_cache.generation
+            response = make_response(view(*args, **kwargs))
+            # Anything that touched the session (a flash, a CSRF token) is specific to this visitor
+            if response.status_code == 200 and not session.modified and 'Set-Cookie' not in response.headers:
+                page_cache.set(key, response.get_data(), response.mimetype, g.page_tags, generation)
+                response.headers['X-Page-Cache'] = 'MISS'
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
+
+def conditional_page(validator):
+    """Answer revalidations of anonymous pages with 304 before the view runs.
+
+    validator(**view_args) returns (version, last_modified) for the data the
+    page shows, or None when it can't tell; the ETag hashes the version with
+    the page's cache key. last_modified is None for pages that can change
+    without it moving, so If-Modified-Since alone never gets them a 304.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not anonymous_request():
+                return view(*args, **kwargs)
+            validators = validator_cache.get_or_load(page_cache_key(), lambda: validator(**kwargs))
+            if validators is None:
+                return view(*args, **kwargs)
+
+            version, last_modified = validators
+            etag = hashlib.sha1(repr((page_cache_key(), version)).encode()).hexdigest()[:32]
+            if last_modified is not None:
+                last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+
+            if request.if_none_match:
+                # gzip-encoded responses carry their own ETag; either one means unchanged
+                not_modified = (request.if_none_match.contains_weak(etag) or
+                                request.if_none_match.contains_weak(f'{etag}-gzip'))
+            else:
+                not_modified = (last_modified is not None and request.if_modified_since is not None
+                                and last_modified <= request.if_modified_since)
+            if not_modified:
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            gzipped = response.headers.get('Content-Encoding') == 'gzip'
+            response.set_etag(f'{etag}-gzip' if gzipped else etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # Shared caches may keep the page but must check back before reusing it
+            response.cache_control.public = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+# Deleting a listing or taking it off the market doesn't move any updated_at, so listing
+# pages are validated by ETag only
+def featured_version():
+    featured = Property.get_featured(limit=6)
+    return [(item.id, item.updated_at) for item in featured], None
+
+def listings_version():
+    filters = listing_filters()
+    # Text matches can't be counted the way the index finds them; search pages aren't validated
+    if 'q' in filters:
+        return None
+    return Property.get_available_version(**filters), None
+
+def property_version(property_id):
+    property_item = Property.get_by_id(property_id)
+    if property_item is None:
+        return None
+    return property_item.updated_at, property_item.updated_at
+
+def property_detail_version(property_id):
+    # The page also shows similar listings, which change as other listings are written
+    property_item = Property.get_by_id(property_id)
+    if property_item is None:
+        return None
+    similar = Property.get_similar(property_id, property_item.property_type, limit=3)
+    return (property_item.updated_at, [(item.id, item.updated_at) for item in similar]), None
+
+def missing_property_response():
+    """Bare 404 for a property id that doesn't exist, the same for every visitor so proxies can keep it.
+
+    Stale links and crawlers ask for deleted ids over and over; this skips the
+    redirect to /properties and the listing query behind it.
+    """
+    body = ('<!DOCTYPE html><html><head><meta charset="UTF-8"><title>Property not found</title></head>'
+            f'<body><p>This property does not exist. <a href="{url_for("properties")}">Browse properties</a></p>'
+            '</body></html>')
+    response = make_response(body, 404)
+    response.headers['Cache-Control'] = f"public, max-age={app.config['MISSING_PROPERTY_CACHE_TTL']}"
+    return response
+
+def gzip_response(view):
+    """gzip the view's response for clients that accept it, unless it is small or already encoded"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        response.vary.add('Accept-Encoding')
+        if (response.status_code == 200 and 'gzip' in request.accept_encodings
+                and 'Content-Encoding' not in response.headers and not response.direct_passthrough
+                and response.content_length >= app.config['API_GZIP_MIN_BYTES']):
+            response.set_data(gzip.compress(response.get_data(), 6))
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+    return wrapper
+
+def api_fields():
+    """Names asked for with ?fields=title,price (id always comes along), or None for every field"""
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return {name.strip() for name in fields.split(',') if name.strip()}
+
+def api_error(message, status):
+    return jsonify({'success': False, 'error': message}), status
+
+@on_property_change
+def purge_listing_pages(action, properties):
+    # Any write can change listing pages; only updates and deletes change an existing detail page
+    tags = ['listings']
+    if action != 'create':
+        tags.extend(f'property:{prop.id}' for prop in properties)
+    page_cache.purge(*tags)
+    validator_cache.clear()
 
 # Authentication routes
 @app.route('/login', methods=['GET', 'POST'])
@@ -104,13 +353,13 @@ def profile():
                 return render_template('profile.html', form=form)
 
             # Update user information
-            current_user.update(
-                first_name=form.first_name.data,
-                last_name=form.last_name.data,
-                email=form.email.data,
-                phone=form.phone.data,
-                password=form.new_password.data if form.new_password.data else None
-            )
+            current_user.first_name = form.first_name.data
+            current_user.last_name = form.last_name.data
+            current_user.email = form.email.data
+            current_user.phone = form.phone.data
+            if form.new_password.data:
+                current_user.set_password(form.new_password.data)
+            current_user.update()
             flash('Profile updated successfully!', 'success')
             return redirect(url_for('profile'))
         except Exception as e:
@@ -163,12 +412,14 @@ def user_add_property():
 def my_properties():
     try:
         page = request.args.get('page', 1, type=int)
+        cursor = request.args.get('cursor')
         per_page = 10
 
         properties_pagination = Property.get_by_user_paginated(
             user_id=current_user.id,
             page=page,
-            per_page=per_page
+            per_page=per_page,
+            cursor=cursor
         )
 
         return render_template('my_properties.html',
@@ -183,15 +434,16 @@ def my_properties():
 @login_required
 def favorites():
     try:
-        favorites = Favorite.get_by_user_id(current_user.id)
-        property_ids = [f.property_id for f in favorites]
-        properties = [Property.get_by_id(pid) for pid in property_ids if Property.get_by_id(pid)]
+        page = request.args.get('page', 1, type=int)
+        favorites_pagination = Property.get_favorites_for_user(current_user.id, page=page, per_page=9)
 
-        return render_template('favorites.html', properties=properties)
+        return render_template('favorites.html',
+                             properties=favorites_pagination.items,
+                             pagination=favorites_pagination)
     except Exception as e:
         print(f"Error in favorites: {str(e)}")
         flash('An error occurred while loading your favorites.', 'error')
-        return render_template('favorites.html', properties=[])
+        return render_template('favorites.html', properties=[], pagination=None)
 
 @app.route('/check-favorite/<int:property_id>')
 @login_required
@@ -203,6 +455,23 @@ def check_favorite(property_id):
         print(f"Error in check_favorite: {str(e)}")
         return jsonify({'error': 'An error occurred'}), 500
 
+@app.route('/favorites/status')
+def favorites_status():
+    # Batch lookup for cards rendered client-side: ?ids=1,2,3 -> {"favorites": {"1": true, ...}}
+    try:
+        ids = []
+        for value in request.args.get('ids', '').split(','):
+            if value.strip().isdecimal():
+                ids.append(int(value))
+        ids = list(dict.fromkeys(ids))[:100]
+        favorited = set()
+        if ids and current_user.is_authenticated:
+            favorited = Favorite.get_favorited_ids(current_user.id, ids)
+        return jsonify({'favorites': {str(pid): pid in favorited for pid in ids}})
+    except Exception as e:
+        print(f"Error in favorites_status: {str(e)}")
+        return jsonify({'error': 'An error occurred'}), 500
+
 @app.route('/toggle-favorite/<int:property_id>', methods=['POST'])
 @login_required
 def toggle_favorite(property_id):
@@ -223,6 +492,8 @@ def toggle_favorite(property_id):
 
 # Main routes
 @app.route('/')
+@conditional_page(featured_version)
+@cached_page('listings')
 def index():
     try:
         featured_properties = Property.get_featured(limit=6)
@@ -239,38 +510,53 @@ def about():
     return render_template('about.html', site_name=Config.SITE_NAME)
 
 @app.route('/properties')
+@conditional_page(listings_version)
+@cached_page('listings')
 def properties():
     try:
-        property_type = request.args.get('type', '')
-        location = request.args.get('location', '')
+        filters = listing_filters()
         page = request.args.get('page', 1, type=int)
+        cursor = request.args.get('cursor')
+        sort = listing_sort()
 
         properties_pagination = Property.get_available(
-            property_type=property_type,
-            location=location,
             page=page,
-            per_page=5
+            per_page=5,
+            cursor=cursor,
+            user_id=current_user_id(),
+            sort=sort,
+            **filters
         )
 
         return render_template('properties.html',
                              properties=properties_pagination.items,
                              pagination=properties_pagination,
-                             search_type=property_type,
-                             search_location=location)
+                             search_type=filters['property_type'],
+                             search_location=filters['location'],
+                             search_query=filters.get('q', ''),
+                             location_options=Location.get_all(),
+                             sort=sort,
+                             link_args=listing_link_args())
     except Exception as e:
         print(f"Error in properties: {str(e)}")
         flash('An error occurred while loading properties.', 'error')
         return render_template('properties.html', properties=[])
 
 @app.route('/property/<int:property_id>')
+@conditional_page(property_detail_version)
+@cached_page()
 def property_detail(property_id):
     try:
         property_item = Property.get_by_id(property_id)
         if not property_item:
-            flash('The requested property was not found.', 'error')
-            return redirect(url_for('properties'))
+            return missing_property_response()
 
-        similar_properties = Property.get_similar(property_id, property_item.property_type, limit=3)
+        user_id = current_user_id()
+        similar_properties = Property.get_similar(property_id, property_item.property_type,
+                                                  limit=3, user_id=user_id)
+        tag_page(property_id, *[similar.id for similar in similar_properties])
+        if user_id is not None:
+            property_item.is_favorited = Favorite.get_by_user_and_property(user_id, property_id) is not None
 
         return render_template('property_detail.html',
                              property=property_item,
@@ -357,6 +643,7 @@ def admin_properties():
         property_type = request.args.get('type', '')
         location = request.args.get('location', '')
         page = request.args.get('page', 1, type=int)
+        cursor = request.args.get('cursor')
         per_page = 5  # Match regular properties page pagination
 
         # Get pagination object with filters (same as regular properties page)
@@ -364,7 +651,8 @@ def admin_properties():
             property_type=property_type,
             location=location,
             page=page,
-            per_page=per_page
+            per_page=per_page,
+            cursor=cursor
         )
 
         return render_template('admin/properties.html',
@@ -446,6 +734,80 @@ def delete_property(property_id):
 
     return redirect(url_for('admin_properties'))
 
+@app.route('/admin/stats')
+@login_required
+def admin_stats():
+    if not current_user.is_admin:
+        return jsonify({'error': 'Admin privileges required'}), 403
+
+    index = similar_index.peek() if similar_index is not None else None
+    listings = listing_index.peek() if listing_index is not None else None
+    text = text_index.peek() if text_index is not None else None
+    return jsonify({
+        'pool': db_conn.pool_stats(),
+        'coalescing': db_conn.coalescing_stats(),
+        'query_cache': db_conn.query_cache_stats(),
+        'cache_backend': cache_backend.stats(),
+        'caches': [property_cache.stats(), user_cache.stats(), session_user_cache.stats(),
+                   featured_cache.stats(), page_cache.stats(), missing_property_cache.stats(),
+                   property_id_filter.stats()],
+        'similar_index': index.stats() if index is not None else None,
+        'listing_index': listings.stats() if listings is not None else None,
+        'text_index': text.stats() if text is not None else None
+    })
+
+# JSON API; the unversioned paths are what static/js/script.js calls
+@app.route('/api/v1/properties')
+@app.route('/api/properties')
+@conditional_page(listings_version)
+@gzip_response
+@cached_page('listings')
+def api_properties():
+    try:
+        per_page = request.args.get('per_page', app.config['API_PER_PAGE'], type=int)
+        per_page = min(max(per_page, 1), app.config['API_MAX_PER_PAGE'])
+        pagination = Property.get_available(
+            page=max(request.args.get('page', 1, type=int), 1),
+            per_page=per_page,
+            cursor=request.args.get('cursor'),
+            sort=listing_sort(),
+            **listing_filters()
+        )
+        fields = api_fields()
+        return jsonify({
+            'success': True,
+            'data': [item.to_dict(fields) for item in pagination.items],
+            'pagination': {
+                'page': pagination.page,
+                'per_page': pagination.per_page,
+                'total': pagination.total,
+                'pages': pagination.pages,
+                'next_cursor': pagination.next_cursor,
+                'prev_cursor': pagination.prev_cursor
+            }
+        })
+    except Exception as e:
+        print(f"Error in api_properties: {str(e)}")
+        return api_error('An error occurred', 500)
+
+@app.route('/api/v1/property/<int:property_id>')
+@app.route('/api/property/<int:property_id>')
+@conditional_page(property_version)
+@gzip_response
+@cached_page()
+def api_property(property_id):
+    try:
+        property_item = Property.get_by_id(property_id)
+        if not property_item:
+            response = make_response(*api_error('Property not found', 404))
+            response.headers['Cache-Control'] = f"public, max-age={app.config['MISSING_PROPERTY_CACHE_TTL']}"
+            return response
+        tag_page(property_id)
+        return jsonify({'success': True, 'data': property_item.to_dict(api_fields())})
+    except Exception as e:
+        print(f"Error in api_property: {str(e)}")
+        return api_error('An error occurred', 500)
+
 # Chat API route
 @app.route('/chat_api', methods=['POST'])
 def chat_api():
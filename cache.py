@@ -0,0 +1,916 @@
+import gzip
+import logging
+import os
+import pickle
+import socket
+import sqlite3
+import stat
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlparse
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_size(value, depth=4):
+    """Rough in-memory size of a cached value: containers and their members, a few levels deep"""
+    size = sys.getsizeof(value)
+    if depth > 0:
+        if isinstance(value, (tuple, list)):
+            size += sum(estimate_size(item, depth - 1) for item in value)
+        elif isinstance(value, dict):
+            size += sum(estimate_size(k, depth - 1) + estimate_size(v, depth - 1) for k, v in value.items())
+    return size
+
+
+# Cache backends.
+#
+# Every cache keeps a private in-process copy. A backend adds the parts that
+# span worker processes: optional shared storage behind that copy, and a
+# channel that carries invalidations to every other worker. Values and
+# messages are pickled, so the shared store must only be reachable by the app.
+
+class CacheBackend:
+    """In-process backend: nothing is shared, and invalidations stay in this worker"""
+
+    name = 'memory'
+    shared = False
+    LISTEN_TIMEOUT = 2.0
+
+    def __init__(self):
+        # Lets a worker skip its own broadcasts, which it has already applied
+        self.sender = uuid.uuid4().hex
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._listener = None
+        self._listening = threading.Event()
+        self._stats = {'gets': 0, 'shared_hits': 0, 'sets': 0, 'deletes': 0,
+                       'broadcasts': 0, 'received': 0, 'errors': 0}
+
+    def get(self, key):
+        """Shared value for key, or None"""
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def on(self, kind, handler):
+        """Call handler(*args) whenever another worker broadcasts `kind`"""
+        with self._lock:
+            self._handlers.setdefault(kind, []).append(handler)
+            if self._listener is None and self.shared:
+                self._listener = threading.Thread(target=self._listen, name=f'{self.name}-cache-listener',
+                                                  daemon=True)
+                self._listener.start()
+                # Don't let this worker write before it can hear other workers' invalidations
+                self._listening.wait(self.LISTEN_TIMEOUT)
+
+    def broadcast(self, kind, *args):
+        """Tell every other worker to apply `kind` with args"""
+        if not self.shared:
+            return
+        self._count('broadcasts')
+        try:
+            self._publish(pickle.dumps((self.sender, kind, args)))
+        except Exception as e:
+            self._error('broadcast', e)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['backend'] = self.name
+        return stats
+
+    def close(self):
+        pass
+
+    def _publish(self, payload):
+        pass
+
+    def _listen(self):
+        pass
+
+    def _receive(self, payload):
+        try:
+            sender, kind, args = pickle.loads(payload)
+        except Exception as e:
+            self._error('decode', e)
+            return
+        if sender == self.sender:
+            return
+        self._count('received')
+        for handler in self._handlers.get(kind, ()):
+            try:
+                handler(*args)
+            except Exception as e:
+                self._error(kind, e)
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _error(self, operation, error):
+        # A cache that can't reach its store degrades to the database, it doesn't fail requests
+        self._count('errors')
+        logger.warning("Cache backend %s %s failed: %s", self.name, operation, error)
+
+
+def _check_private(path):
+    """Refuse a cache path another local user owns or can write, since its contents are unpickled"""
+    if not hasattr(os, 'getuid'):
+        # Windows: access is by ACL, and the default location is the per-user temp directory
+        return
+    info = os.lstat(path)
+    if stat.S_ISLNK(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o022:
+        raise Exception(f"Cache path {path} must belong to this user and not be writable by others")
+
+
+def _private_directory():
+    """A directory under /dev/shm (or the temp dir) that only this user can reach"""
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    directory = os.path.join(base, f'proestate-{os.getuid()}' if hasattr(os, 'getuid') else 'proestate')
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    _check_private(directory)
+    return directory
+
+
+class FileBackend(CacheBackend):
+    """SQLite file shared by the workers on one host, kept in a private directory in /dev/shm
+    when it exists.
+
+    Invalidations are appended to an events table that every worker polls.
+    """
+
+    name = 'file'
+    shared = True
+    POLL_INTERVAL = 0.2
+    EVENT_RETENTION = 60
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS cache_entries (
+        key TEXT PRIMARY KEY,
+        value BLOB NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS cache_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payload BLOB NOT NULL,
+        created_at REAL NOT NULL
+    );
+    """
+
+    def __init__(self, path=None):
+        super().__init__()
+        if not path:
+            path = os.path.join(_private_directory(), 'cache.db')
+        # Created here rather than by SQLite so that it is private from the start
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600))
+        _check_private(path)
+        self.path = path
+        self._local = threading.local()
+        self._last_prune = 0.0
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        # Only events published from now on concern this worker
+        self._last_event = conn.execute("SELECT COALESCE(MAX(id), 0) FROM cache_events").fetchone()[0]
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        self._count('gets')
+        try:
+            row = self._conn().execute(
+                "SELECT value FROM cache_entries WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            self._error('get', e)
+            return None
+        if row is None:
+            return None
+        self._count('shared_hits')
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl):
+        self._count('sets')
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, pickle.dumps(value), time.time() + ttl)
+            )
+        except sqlite3.Error as e:
+            self._error('set', e)
+
+    def delete(self, key):
+        self._count('deletes')
+        try:
+            self._conn().execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            self._error('delete', e)
+
+    def _publish(self, payload):
+        now = time.time()
+        conn = self._conn()
+        conn.execute("INSERT INTO cache_events (payload, created_at) VALUES (?, ?)", (payload, now))
+        if now - self._last_prune > self.EVENT_RETENTION:
+            self._last_prune = now
+            conn.execute("DELETE FROM cache_events WHERE created_at < ?", (now - self.EVENT_RETENTION,))
+            conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (now,))
+
+    def _listen(self):
+        self._listening.set()
+        while True:
+            time.sleep(self.POLL_INTERVAL)
+            try:
+                rows = self._conn().execute(
+                    "SELECT id, payload FROM cache_events WHERE id > ? ORDER BY id", (self._last_event,)
+                ).fetchall()
+            except sqlite3.Error as e:
+                self._error('poll', e)
+                continue
+            for event_id, payload in rows:
+                self._last_event = event_id
+                self._receive(payload)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RespError(Exception):
+    """Error reply from a Redis-protocol server"""
+
+
+def resp_encode(value):
+    """Encode a command (list of args) or reply in the Redis serialization protocol"""
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, RespError):
+        return b'-' + str(value).encode() + b'\r\n'
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b':' + str(value).encode() + b'\r\n'
+    if isinstance(value, (list, tuple)):
+        return b'*' + str(len(value)).encode() + b'\r\n' + b''.join(resp_encode(item) for item in value)
+    if isinstance(value, str):
+        value = value.encode()
+    return b'$' + str(len(value)).encode() + b'\r\n' + value + b'\r\n'
+
+
+def resp_read(stream):
+    """Read one value from a binary file object; error replies come back as RespError"""
+    line = stream.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest.decode()
+    if kind == b'-':
+        return RespError(rest.decode())
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = stream.read(length + 2)
+        return data[:-2]
+    if kind == b'*':
+        length = int(rest)
+        if length < 0:
+            return None
+        return [resp_read(stream) for _ in range(length)]
+    raise ConnectionError(f"Unexpected reply: {line!r}")
+
+
+class RespConnection:
+    """One socket to a Redis-protocol server"""
+
+    def __init__(self, host, port, db=0, timeout=2.0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.stream = self.sock.makefile('rb')
+        if db:
+            self.command('SELECT', db)
+
+    def send(self, *args):
+        self.sock.sendall(resp_encode(list(args)))
+
+    def read(self):
+        return resp_read(self.stream)
+
+    def command(self, *args):
+        self.send(*args)
+        reply = self.read()
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def close(self):
+        try:
+            self.stream.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisBackend(CacheBackend):
+    """Redis (or anything speaking its protocol) shared by workers on any number of hosts.
+
+    Invalidations go out with PUBLISH and arrive on a dedicated SUBSCRIBE
+    connection. resp_server.py is a stand-in for development and tests.
+    """
+
+    name = 'redis'
+    shared = True
+    RECONNECT_DELAY = 1.0
+
+    def __init__(self, url, prefix='proestate:'):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.prefix = prefix
+        self.channel = f'{prefix}invalidate'
+        self._local = threading.local()
+
+    def _command(self, *args):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = RespConnection(self.host, self.port, self.db)
+        try:
+            return conn.command(*args)
+        except (OSError, ConnectionError):
+            # Drop the broken socket; the next command reconnects
+            conn.close()
+            self._local.conn = None
+            raise
+
+    def get(self, key):
+        self._count('gets')
+        try:
+            data = self._command('GET', self.prefix + key)
+        except (OSError, ConnectionError, RespError) as e:
+            self._error('get', e)
+            return None
+        if data is None:
+            return None
+        self._count('shared_hits')
+        return pickle.loads(data)
+
+    def set(self, key, value, ttl):
+        self._count('sets')
+        try:
+            self._command('SET', self.prefix + key, pickle.dumps(value), 'PX', max(1, int(ttl * 1000)))
+        except (OSError, ConnectionError, RespError) as e:
+            self._error('set', e)
+
+    def delete(self, key):
+        self._count('deletes')
+        try:
+            self._command('DEL', self.prefix + key)
+        except (OSError, ConnectionError, RespError) as e:
+            self._error('delete', e)
+
+    def _publish(self, payload):
+        self._command('PUBLISH', self.channel, payload)
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = RespConnection(self.host, self.port, self.db, timeout=None)
+                conn.send('SUBSCRIBE', self.channel)
+                conn.read()
+                self._listening.set()
+                while True:
+                    reply = conn.read()
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b'message':
+                        self._receive(reply[2])
+            except (OSError, ConnectionError) as e:
+                self._error('subscribe', e)
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(self.RECONNECT_DELAY)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def create_cache_backend(config=Config):
+    """Cache backend chosen by config.CACHE_BACKEND"""
+    backend = config.CACHE_BACKEND.lower()
+    if backend == 'memory':
+        return CacheBackend()
+    if backend == 'file':
+        return FileBackend(config.CACHE_FILE_PATH)
+    if backend == 'redis':
+        return RedisBackend(config.CACHE_REDIS_URL)
+    raise Exception(f"Unknown cache backend: {config.CACHE_BACKEND}")
+
+
+class LRUCache:
+    """Thread-safe LRU cache with a per-entry TTL and caps on entry count and memory.
+
+    Values should be immutable (row tuples rather than model objects) so that a
+    caller mutating what it got back can't change what the next caller sees.
+    With a backend, deletes reach every worker's copy; with shared=True the
+    backend's store also sits behind this one, so a worker's miss can be
+    another worker's hit.
+    """
+
+    def __init__(self, name, max_entries=1000, ttl=300, max_bytes=None, backend=None, shared=False):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.backend = backend or CacheBackend()
+        self.shared = shared and self.backend.shared
+        self._entries = OrderedDict()   # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a load that raced a write isn't cached
+        self._generation = 0
+        self._stats = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0,
+                       'invalidations': 0}
+        self.backend.on(f'delete:{name}', self._delete_local)
+        self.backend.on(f'clear:{name}', self._clear_local)
+
+    def _shared_key(self, key):
+        return f'{self.name}:{key!r}'
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at, size = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return value
+                self._remove(key)
+                self._stats['expirations'] += 1
+            generation = self._generation
+
+        if self.shared:
+            value = self.backend.get(self._shared_key(key))
+            if value is not None:
+                self._store(key, value, self.ttl, generation)
+                with self._lock:
+                    self._stats['shared_hits'] += 1
+                return value
+        with self._lock:
+            self._stats['misses'] += 1
+        return default
+
+    def set(self, key, value, ttl=None, generation=None):
+        """Store value; skipped when an invalidation happened since `generation` was read"""
+        ttl = self.ttl if ttl is None else ttl
+        if self._store(key, value, ttl, generation) and self.shared:
+            self.backend.set(self._shared_key(key), value, ttl)
+
+    def _store(self, key, value, ttl, generation):
+        size = estimate_size(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic() + ttl, size)
+            self._bytes += size
+            self._evict()
+        return True
+
+    @property
+    def generation(self):
+        """Pass to set() so a value read before an invalidation isn't stored"""
+        return self._generation
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Cached value for key, calling loader() on a miss; None results aren't cached"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        generation = self._generation
+        value = loader()
+        if value is not None:
+            self.set(key, value, ttl, generation)
+        return value
+
+    def keys(self):
+        """Keys of the entries that haven't expired"""
+        now = time.monotonic()
+        with self._lock:
+            return [key for key, (value, expires_at, size) in self._entries.items() if expires_at > now]
+
+    def delete(self, key):
+        self._delete_local(key)
+        if self.shared:
+            self.backend.delete(self._shared_key(key))
+        self.backend.broadcast(f'delete:{self.name}', key)
+
+    def clear(self):
+        """Empty every worker's copy; shared entries can't be enumerated and age out by TTL"""
+        self._clear_local()
+        self.backend.broadcast(f'clear:{self.name}')
+
+    def _delete_local(self, key):
+        with self._lock:
+            self._generation += 1
+            self._stats['invalidations'] += 1
+            if key in self._entries:
+                self._remove(key)
+
+    def _clear_local(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(name=self.name, entries=len(self._entries), bytes=self._bytes,
+                         max_entries=self.max_entries, max_bytes=self.max_bytes, shared=self.shared)
+        lookups = stats['hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['hits'] + stats['shared_hits']) / lookups if lookups else 0.0
+        return stats
+
+    def _remove(self, key):
+        value, expires_at, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or
+                                 (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self._stats['evictions'] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one; the rest wait for its result"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # calls: fn() actually run; saved: callers served by another's call instead;
+        # timeouts: callers that gave up waiting and ran fn() themselves
+        self._stats = {'calls': 0, 'saved': 0, 'timeouts': 0}
+
+    def do(self, key, fn, timeout=None):
+        """Run fn() for key, or wait up to timeout seconds for the call already running"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            self._stats['calls' if leader else 'saved'] += 1
+        if not leader:
+            if not call.done.wait(timeout):
+                with self._lock:
+                    self._stats['saved'] -= 1
+                    self._stats['timeouts'] += 1
+                    self._stats['calls'] += 1
+                return fn()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls)
+        return stats
+
+
+class CachedValue:
+    """One computed value kept until it is invalidated or its TTL runs out.
+
+    After an invalidation only one caller recomputes it; callers arriving
+    meanwhile wait for that result instead of hitting the database too.
+    Invalidations are broadcast through the backend to every worker.
+    """
+
+    def __init__(self, name, loader, ttl=None, backend=None):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.backend = backend or CacheBackend()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._value = None
+        self._valid = False
+        self._expires_at = None
+        self._generation = 0
+        self._stats = {'hits': 0, 'misses': 0, 'loads': 0, 'invalidations': 0, 'refresh_errors': 0}
+        self.backend.on(f'invalidate:{name}', self._invalidate_local)
+
+    def get(self):
+        with self._lock:
+            if self._valid and (self._expires_at is None or self._expires_at > time.monotonic()):
+                self._stats['hits'] += 1
+                return self._value
+            self._stats['misses'] += 1
+            generation = self._generation
+        # Keyed by generation so a load that started before an invalidation isn't joined
+        return self._flight.do(generation, lambda: self._load(generation))
+
+    def _load(self, generation):
+        value = self.loader()
+        with self._lock:
+            self._stats['loads'] += 1
+            if generation == self._generation:
+                self._value = value
+                self._valid = True
+                self._expires_at = time.monotonic() + self.ttl if self.ttl else None
+        return value
+
+    def peek(self):
+        """The current value if one is loaded, without loading it; None otherwise"""
+        with self._lock:
+            if self._valid and (self._expires_at is None or self._expires_at > time.monotonic()):
+                return self._value
+        return None
+
+    def invalidate(self):
+        self._invalidate_local()
+        self.backend.broadcast(f'invalidate:{self.name}')
+
+    def _invalidate_local(self):
+        with self._lock:
+            self._generation += 1
+            self._valid = False
+            self._stats['invalidations'] += 1
+
+    def refresh(self):
+        """Invalidate and recompute now, so the next reader finds a warm value"""
+        self.invalidate()
+        try:
+            self.get()
+        except Exception:
+            # Readers will retry the load; the write that triggered this has already succeeded
+            with self._lock:
+                self._stats['refresh_errors'] += 1
+            logger.exception("Error refreshing %s cache", self.name)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(name=self.name, valid=self._valid)
+        return stats
+
+
+class TaggedCache:
+    """LRU entries labelled with tags (e.g. the tables a query read), invalidated a tag at a time.
+
+    Every tag has a version. An entry keeps the versions that were current
+    when its value was read and is ignored once any of them has moved on, so
+    a value read before an invalidation but stored after it is never served.
+    Invalidations are broadcast through the backend to every worker.
+    """
+
+    def __init__(self, name, max_entries=1000, ttl=60, max_bytes=None, backend=None):
+        self.name = name
+        self.ttl = ttl
+        self.backend = backend or CacheBackend()
+        self._entries = LRUCache(name, max_entries=max_entries, ttl=ttl, max_bytes=max_bytes)
+        self._lock = threading.Lock()
+        self._versions = {}     # tag -> version
+        self._epoch = 0         # bumped by clear(), part of every entry's versions
+        self._stats = {'stale': 0, 'invalidations': 0}
+        self.backend.on(f'invalidate_tags:{name}', self._invalidate_local)
+        self.backend.on(f'clear:{name}', self._clear_local)
+
+    def versions(self, tags):
+        """Snapshot to pass to set() for a value about to be read"""
+        with self._lock:
+            return (self._epoch,) + tuple(self._versions.get(tag, 0) for tag in tags)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, tags, versions = entry
+        if versions != self.versions(tags):
+            with self._lock:
+                self._stats['stale'] += 1
+            self._entries.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, tags, versions, ttl=None):
+        """Store value unless one of tags was invalidated after `versions` was taken"""
+        if versions == self.versions(tags):
+            self._entries.set(key, (value, tuple(tags), versions), ttl)
+
+    def invalidate(self, *tags):
+        """Drop every entry carrying any of tags, in every worker"""
+        if not tags:
+            return
+        self._invalidate_local(*tags)
+        self.backend.broadcast(f'invalidate_tags:{self.name}', *tags)
+
+    def _invalidate_local(self, *tags):
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+            self._stats['invalidations'] += 1
+
+    def clear(self):
+        self._clear_local()
+        self.backend.broadcast(f'clear:{self.name}')
+
+    def _clear_local(self):
+        with self._lock:
+            self._epoch += 1
+            self._stats['invalidations'] += 1
+        self._entries.clear()
+
+    def stats(self):
+        stats = self._entries.stats()
+        with self._lock:
+            stats.update(self._stats)
+            stats['tags'] = len(self._versions)
+        return stats
+
+
+class IdFilter:
+    """Which integer ids exist, one bit per id up to a high-water mark.
+
+    Identity columns never hand out an id twice, so an id at or below
+    `max_id` whose bit is clear is known not to exist; ids above it may have
+    been inserted since the filter was built and are reported as possible.
+    """
+
+    def __init__(self, ids=(), max_id=0):
+        self.max_id = max_id
+        self._bits = bytearray(max_id // 8 + 1)
+        self._lock = threading.Lock()
+        for id_ in ids:
+            if 0 < id_ <= max_id:
+                self._bits[id_ >> 3] |= 1 << (id_ & 7)
+
+    def might_exist(self, id_):
+        if id_ <= 0:
+            return False
+        if id_ > self.max_id:
+            return True
+        return bool(self._bits[id_ >> 3] & (1 << (id_ & 7)))
+
+    def add(self, *ids):
+        with self._lock:
+            for id_ in ids:
+                if 0 < id_ <= self.max_id:
+                    self._bits[id_ >> 3] |= 1 << (id_ & 7)
+
+    def discard(self, *ids):
+        with self._lock:
+            for id_ in ids:
+                if 0 < id_ <= self.max_id:
+                    self._bits[id_ >> 3] &= ~(1 << (id_ & 7)) & 0xFF
+
+    def stats(self):
+        return {'max_id': self.max_id, 'bytes': len(self._bits)}
+
+
+class PageCache:
+    """Rendered pages stored gzip-compressed, purgeable by tag (e.g. the listings a page shows)"""
+
+    def __init__(self, name, max_entries=1000, ttl=120, max_bytes=None, backend=None):
+        self.name = name
+        self.backend = backend or CacheBackend()
+        self._pages = LRUCache(name, max_entries=max_entries, ttl=ttl, max_bytes=max_bytes)
+        self._lock = threading.Lock()
+        self._tags = {}     # tag -> keys of pages carrying it
+        self._keys = {}     # key -> tags of its page, so evicted and expired pages can be untagged
+        # Bumped by every purge, so a page rendered before one isn't stored
+        self._generation = 0
+        self._stats = {'stores': 0, 'bypasses': 0, 'purges': 0}
+        self.backend.on(f'purge:{name}', self._purge_local)
+        self.backend.on(f'clear:{name}', self._clear_local)
+
+    @property
+    def generation(self):
+        """Read before rendering a page and pass to set()"""
+        return self._generation
+
+    def get(self, key):
+        """(gzipped body, mimetype) for key, or None"""
+        return self._pages.get(key)
+
+    def set(self, key, body, mimetype, tags=(), generation=None):
+        """Store a page; skipped when a purge happened since `generation` was read"""
+        body = gzip.compress(body, 6)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if len(self._keys) >= 2 * self._pages.max_entries:
+                self._prune()
+            self._stats['stores'] += 1
+            self._keys.setdefault(key, set()).update(tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            # Stored under the lock, so a purge can't slip in between the check and the store
+            self._pages.set(key, (body, mimetype))
+
+    def _forget(self, key):
+        for tag in self._keys.pop(key, ()):
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def _prune(self):
+        """Untag pages the LRU has evicted or let expire"""
+        live = set(self._pages.keys())
+        for key in [key for key in self._keys if key not in live]:
+            self._forget(key)
+
+    def purge(self, *tags):
+        """Drop every page carrying any of tags, in every worker"""
+        self._purge_local(*tags)
+        self.backend.broadcast(f'purge:{self.name}', *tags)
+
+    def _purge_local(self, *tags):
+        keys = set()
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                keys.update(self._tags.get(tag, ()))
+            for key in keys:
+                self._forget(key)
+            self._stats['purges'] += len(keys)
+        for key in keys:
+            self._pages.delete(key)
+
+    def clear(self):
+        self._clear_local()
+        self.backend.broadcast(f'clear:{self.name}')
+
+    def _clear_local(self):
+        with self._lock:
+            self._generation += 1
+            self._tags.clear()
+            self._keys.clear()
+        self._pages.clear()
+
+    def bypassed(self):
+        """Count a request that was served without consulting the cache"""
+        with self._lock:
+            self._stats['bypasses'] += 1
+
+    def stats(self):
+        stats = self._pages.stats()
+        with self._lock:
+            stats.update(self._stats)
+            stats['tags'] = len(self._tags)
+        return stats
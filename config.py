@@ -6,3 +6,96 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SITE_NAME = 'ProEstate'
     OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY') or 'your-openai-api-key-here'
+
+    # Database backend: 'mssql' (SQL Server over ODBC) or 'sqlite' (embedded file in WAL mode,
+    # stored at the SQLALCHEMY_DATABASE_URI path)
+    DATABASE_BACKEND = os.environ.get('DATABASE_BACKEND') or 'mssql'
+    MSSQL_CONNECTION_STRING = os.environ.get('MSSQL_CONNECTION_STRING') or (
+        'DRIVER={ODBC Driver 17 for SQL Server};'
+        'SERVER=localhost\\SQLEXPRESS;'
+        'DATABASE=ProEstate;'
+        'Trusted_Connection=yes;'
+    )
+
+    # Database connection pool
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 10)
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT') or 30)
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE') or 1800)
+    DB_POOL_PING_AFTER = int(os.environ.get('DB_POOL_PING_AFTER') or 30)
+
+    # Query instrumentation: statements slower than this are logged, and a statement shape
+    # repeated this many times in one request is reported as a likely N+1 loop
+    DB_SLOW_QUERY_MS = float(os.environ.get('DB_SLOW_QUERY_MS') or 200)
+    DB_N_PLUS_ONE_THRESHOLD = int(os.environ.get('DB_N_PLUS_ONE_THRESHOLD') or 3)
+    # Send X-DB-* diagnostics headers on every response (always on when app.debug is set)
+    DB_DEBUG_HEADERS = os.environ.get('DB_DEBUG_HEADERS', '').lower() in ('1', 'true', 'yes')
+
+    # Cache backend shared by worker processes: 'memory' (nothing shared), 'file' (SQLite file in
+    # /dev/shm, for several workers on one host) or 'redis' (any Redis-protocol server). The file
+    # defaults to a directory in /dev/shm only this user can reach; a CACHE_FILE_PATH must belong
+    # to the app's user and not be writable by others.
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND') or 'memory'
+    CACHE_FILE_PATH = os.environ.get('CACHE_FILE_PATH')
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL') or 'redis://127.0.0.1:6379/0'
+
+    # In-process cache of single-row lookups (Property/User get_by_id), per worker process
+    OBJECT_CACHE_MAX_ENTRIES = int(os.environ.get('OBJECT_CACHE_MAX_ENTRIES') or 5000)
+    OBJECT_CACHE_TTL = int(os.environ.get('OBJECT_CACHE_TTL') or 300)
+    OBJECT_CACHE_MAX_BYTES = int(os.environ.get('OBJECT_CACHE_MAX_BYTES') or 32 * 1024 * 1024)
+    # Logged-in users are reloaded at least this often even if nothing bumps their version
+    SESSION_USER_CACHE_TTL = int(os.environ.get('SESSION_USER_CACHE_TTL') or 60)
+    # Homepage featured listings are refreshed by listing writes; the TTL only bounds how long
+    # writes made by other worker processes take to show up
+    FEATURED_CACHE_TTL = int(os.environ.get('FEATURED_CACHE_TTL') or 300)
+    # Property ids known not to exist, so stale links and crawlers get a 404 without a query.
+    # The id filter covers ids up to its cap and is rebuilt this often to pick up other
+    # workers' deletes; the LRU holds misses above the filter's range.
+    MISSING_PROPERTY_CACHE_MAX_ENTRIES = int(os.environ.get('MISSING_PROPERTY_CACHE_MAX_ENTRIES') or 10000)
+    MISSING_PROPERTY_CACHE_TTL = int(os.environ.get('MISSING_PROPERTY_CACHE_TTL') or 600)
+    PROPERTY_ID_FILTER_TTL = int(os.environ.get('PROPERTY_ID_FILTER_TTL') or 3600)
+    PROPERTY_ID_FILTER_MAX_ID = int(os.environ.get('PROPERTY_ID_FILTER_MAX_ID') or 50000000)
+    # The in-memory listing indexes below see a worker's own listing writes at once, and other
+    # workers' only through a 'file' or 'redis' CACHE_BACKEND. Writes they don't hear about (every
+    # other worker's with 'memory', raw SQL from init_db and migrations) show up when the index is
+    # next rebuilt, so without a shared backend they are rebuilt as often as the featured cache.
+    INDEX_TTL = 300 if CACHE_BACKEND == 'memory' else 3600
+    # Nearest-neighbour index for "similar properties" (needs NumPy), kept current by listing
+    # writes and rebuilt this often, which also re-derives its feature scaling
+    SIMILAR_INDEX_ENABLED = os.environ.get('SIMILAR_INDEX_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    SIMILAR_INDEX_TTL = int(os.environ.get('SIMILAR_INDEX_TTL') or INDEX_TTL)
+    # Column store of available listings answering /properties filters and sorts (needs NumPy),
+    # loaded at startup and kept current like the similar-listings index
+    LISTING_INDEX_ENABLED = os.environ.get('LISTING_INDEX_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    LISTING_INDEX_TTL = int(os.environ.get('LISTING_INDEX_TTL') or INDEX_TTL)
+    # Full-text index of listing titles, descriptions and locations behind /properties?q=
+    # (needs NumPy; SQL LIKE answers until it's loaded), kept current the same way; rebuilds
+    # also compact it
+    TEXT_INDEX_ENABLED = os.environ.get('TEXT_INDEX_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    TEXT_INDEX_TTL = int(os.environ.get('TEXT_INDEX_TTL') or INDEX_TTL)
+    # The locations hierarchy listings are filed under, reloaded this often in each worker
+    LOCATION_TREE_TTL = int(os.environ.get('LOCATION_TREE_TTL') or 3600)
+
+    # Rendered HTML of /, /properties and /property/<id> for anonymous visitors, per process
+    PAGE_CACHE_ENABLED = os.environ.get('PAGE_CACHE_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES') or 2000)
+    PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL') or 120)
+    PAGE_CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES') or 64 * 1024 * 1024)
+
+    # JSON listing API (/api/v1/properties): page size when none is asked for and the most one
+    # page may hold; responses at least this long are gzip-compressed for clients that accept it
+    API_PER_PAGE = int(os.environ.get('API_PER_PAGE') or 20)
+    API_MAX_PER_PAGE = int(os.environ.get('API_MAX_PER_PAGE') or 100)
+    API_GZIP_MIN_BYTES = int(os.environ.get('API_GZIP_MIN_BYTES') or 1024)
+
+    # Identical SELECTs (same SQL and params) running concurrently share one execution; a waiter
+    # gives up and runs its own query after this many seconds
+    DB_COALESCE_READS = os.environ.get('DB_COALESCE_READS', '1').lower() in ('1', 'true', 'yes')
+    DB_COALESCE_TIMEOUT = float(os.environ.get('DB_COALESCE_TIMEOUT') or 5)
+
+    # Result rows of reads that opt in with execute_query(..., cache_ttl=...), per process; a
+    # commit drops every cached result that read a table it wrote. Larger results aren't kept.
+    QUERY_CACHE_ENABLED = os.environ.get('QUERY_CACHE_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    QUERY_CACHE_MAX_ENTRIES = int(os.environ.get('QUERY_CACHE_MAX_ENTRIES') or 2000)
+    QUERY_CACHE_MAX_BYTES = int(os.environ.get('QUERY_CACHE_MAX_BYTES') or 32 * 1024 * 1024)
+    QUERY_CACHE_MAX_ROWS = int(os.environ.get('QUERY_CACHE_MAX_ROWS') or 1000)
+    QUERY_CACHE_TTL = int(os.environ.get('QUERY_CACHE_TTL') or 300)
@@ -1,119 +1,1073 @@
-import pyodbc
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
+from cache import SingleFlight, TaggedCache
+from config import Config
+
+try:
+    import pyodbc
+except ImportError:  # SQLite-only installs don't need the ODBC driver
+    pyodbc = None
+
+logger = logging.getLogger(__name__)
+
+
+# SQLite hands back whatever text was stored; convert declared date/bit columns
+# so rows look the same as they do coming from pyodbc
+def _convert_datetime(value):
+    return datetime.fromisoformat(value.decode())
+
+
+def _convert_bit(value):
+    return value not in (b'0', b'')
+
+
+# Fixed-width timestamps so stored values compare correctly as text (keyset pagination)
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' ', timespec='microseconds'))
+for _decl in ('DATETIME', 'DATETIME2', 'TIMESTAMP'):
+    sqlite3.register_converter(_decl, _convert_datetime)
+for _decl in ('BIT', 'BOOLEAN'):
+    sqlite3.register_converter(_decl, _convert_bit)
+
+
+class Dialect:
+    """Backend-specific connection setup and SQL rewriting"""
+    name = None
+    Error = Exception
+    ping_query = 'SELECT 1'
+    # Statement that opens a transaction DDL joins too, where the driver would otherwise run DDL
+    # outside one; None when every statement already runs in a transaction
+    begin_statement = None
+    # Bind-parameter and VALUES-row limits for a single multi-row INSERT
+    max_params = 999
+    max_rows = 1000
+
+    def connect(self):
+        raise NotImplementedError
+
+    def translate(self, query, params=None):
+        """Rewrite a T-SQL statement for this backend; returns (query, params)"""
+        return query, params
+
+    def returning(self, query, column='id'):
+        """Make an INSERT statement hand back the given column of the new row"""
+        raise NotImplementedError
+
+    def insert_many(self, cursor, table, columns, rows, id_column=None):
+        """Insert a batch of rows; returns their new ids in input order when id_column is set"""
+        column_list = ', '.join(columns)
+        if id_column is None:
+            placeholders = ', '.join('?' for _ in columns)
+            cursor.executemany(f"INSERT INTO {table} ({column_list}) VALUES ({placeholders})", rows)
+            return []
+
+        ids = []
+        for chunk in self._chunks(rows, len(columns)):
+            query = self.returning(
+                f"INSERT INTO {table} ({column_list}) VALUES {_values_rows(len(chunk), len(columns))}",
+                id_column,
+            )
+            cursor.execute(query, [value for row in chunk for value in row])
+            # Identity values increase in insert order, so sorting lines them up with the input
+            ids.extend(sorted(int(row[0]) for row in cursor.fetchall()))
+        return ids
+
+    def _chunks(self, rows, width):
+        size = max(1, min(self.max_rows, self.max_params // width))
+        for start in range(0, len(rows), size):
+            yield rows[start:start + size]
+
+
+@lru_cache(maxsize=64)
+def _values_rows(count, width):
+    row = '(' + ', '.join('?' for _ in range(width)) + ')'
+    return ', '.join(row for _ in range(count))
+
+
+_INSERT_COLUMNS_RE = re.compile(r"^(\s*INSERT\s+INTO\s+[\w.\[\]]+\s*\([^)]*\))", re.I)
+
+
+class SQLServerDialect(Dialect):
+    """SQL Server over ODBC; queries are written in T-SQL so they pass through unchanged"""
+    name = 'mssql'
+    max_params = 2099
+
+    def __init__(self, connection_string):
+        if pyodbc is None:
+            raise Exception("The SQL Server backend requires the pyodbc package")
+        self.connection_string = connection_string
+        self.Error = pyodbc.Error
+
+    def connect(self):
+        return pyodbc.connect(self.connection_string)
+
+    def returning(self, query, column='id'):
+        return _mssql_output_clause(query, column)
+
+    def insert_many(self, cursor, table, columns, rows, id_column=None):
+        column_list = ', '.join(columns)
+        if id_column is None:
+            # Binds the whole batch as parameter arrays and sends it in one round trip
+            placeholders = ', '.join('?' for _ in columns)
+            cursor.raw.fast_executemany = True
+            cursor.executemany(f"INSERT INTO {table} ({column_list}) VALUES ({placeholders})", rows)
+            return []
+
+        # INSERT ... SELECT ... ORDER BY guarantees identity values follow the ORDER BY,
+        # so the sorted OUTPUT ids line up with the input rows
+        ids = []
+        for chunk in self._chunks(rows, len(columns) + 1):
+            values = ', '.join(
+                '(' + ', '.join('?' for _ in columns) + f', {i})' for i in range(len(chunk))
+            )
+            query = (
+                f"INSERT INTO {table} ({column_list}) OUTPUT INSERTED.{id_column} "
+                f"SELECT {column_list} FROM (VALUES {values}) AS v ({column_list}, _ord) ORDER BY _ord"
+            )
+            cursor.execute(query, [value for row in chunk for value in row])
+            ids.extend(sorted(int(row[0]) for row in cursor.fetchall()))
+        return ids
+
+
+@lru_cache(maxsize=128)
+def _mssql_output_clause(query, column):
+    match = _INSERT_COLUMNS_RE.match(query)
+    if not match:
+        raise Exception("Expected an INSERT INTO table (columns) statement")
+    return f"{match.group(1)} OUTPUT INSERTED.{column}{query[match.end():]}"
+
+
+# Tokens for the TOP relocation pass: string literals, placeholders, parentheses, other text
+_TOKEN_RE = re.compile(r"'(?:[^']|'')*'|\?|\(|\)|[^'?()]+")
+_TOP_RE = re.compile(r"\bTOP\s*$", re.I)
+_TOP_LITERAL_RE = re.compile(r"\bTOP\s+(\d+)\b", re.I)
+
+_TSQL_REWRITES = [
+    (re.compile(r"\bOFFSET\s+(\?|\d+)\s+ROWS?\s+FETCH\s+(?:NEXT|FIRST)\s+(\?|\d+)\s+ROWS?\s+ONLY", re.I),
+     r"LIMIT \1, \2"),
+    (re.compile(r"\bSCOPE_IDENTITY\(\)|@@IDENTITY", re.I), "last_insert_rowid()"),
+    (re.compile(r"\b(?:GETDATE|GETUTCDATE|SYSDATETIME)\(\)", re.I), "CURRENT_TIMESTAMP"),
+    (re.compile(r"\bN?VARCHAR\s*\(\s*MAX\s*\)", re.I), "TEXT"),
+    (re.compile(r"\bINT\s+IDENTITY\s*\(\s*1\s*,\s*1\s*\)\s+PRIMARY\s+KEY", re.I),
+     "INTEGER PRIMARY KEY AUTOINCREMENT"),
+    (re.compile(r"IF\s+OBJECT_ID\('(\w+)',\s*'U'\)\s+IS\s+NOT\s+NULL\s+DROP\s+TABLE\s+\w+\s*;?", re.I),
+     r"DROP TABLE IF EXISTS \1"),
+    (re.compile(r"IF\s+OBJECT_ID\('(\w+)',\s*'U'\)\s+IS\s+NULL\s+CREATE\s+TABLE\s+", re.I),
+     "CREATE TABLE IF NOT EXISTS "),
+    # Covering columns are a SQL Server feature; SQLite just uses the key columns
+    (re.compile(r"\s+INCLUDE\s*\([^)]*\)", re.I), ""),
+    (re.compile(r"\bLEN\(", re.I), "LENGTH("),
+    (re.compile(r"\bISNULL\(", re.I), "IFNULL("),
+]
+
+
+def _relocate_top(query):
+    """Turn each TOP (n) into a LIMIT at the end of its own (sub)query.
+
+    Returns the new statement and, when a moved placeholder changes the
+    parameter order, the original index of each placeholder in new order.
+    """
+    tokens = _TOKEN_RE.findall(query)
+    stack = [[[], None]]  # per parenthesis scope: output pieces, pending limit
+    placeholder = 0
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        pieces = stack[-1][0]
+        if token == '(':
+            stack.append([['('], None])
+        elif token == ')' and len(stack) > 1:
+            scope_pieces, limit = stack.pop()
+            _close_scope(scope_pieces, limit)
+            scope_pieces.append(')')
+            stack[-1][0].extend(scope_pieces)
+        elif token == '?':
+            pieces.append(placeholder)
+            placeholder += 1
+        elif token.startswith("'"):
+            pieces.append(token)
+        else:
+            match = _TOP_RE.search(token)
+            if match and tokens[i + 1:i + 2] == ['('] and tokens[i + 3:i + 4] == [')']:
+                count = tokens[i + 2].strip()
+                pieces.append(token[:match.start()])
+                if count == '?':
+                    stack[-1][1] = placeholder
+                    placeholder += 1
+                else:
+                    stack[-1][1] = count
+                i += 4
+                continue
+            literal = _TOP_LITERAL_RE.search(token)
+            if literal:
+                stack[-1][1] = literal.group(1)
+                token = token[:literal.start()] + token[literal.end():]
+            pieces.append(token)
+        i += 1
+
+    while len(stack) > 1:  # unbalanced input; fold what is left back together
+        scope_pieces, limit = stack.pop()
+        stack[-1][0].extend(scope_pieces)
+    pieces, limit = stack[0]
+    _close_scope(pieces, limit)
+
+    order = []
+    sql = []
+    for piece in pieces:
+        if isinstance(piece, int):
+            order.append(piece)
+            sql.append('?')
+        else:
+            sql.append(piece)
+    if order == sorted(order):
+        order = None
+    return ''.join(sql), order
+
+
+def _close_scope(pieces, limit):
+    if limit is None:
+        return
+    while pieces and isinstance(pieces[-1], str) and not pieces[-1].strip(' \t\r\n;'):
+        pieces.pop()
+    if pieces and isinstance(pieces[-1], str):
+        pieces[-1] = pieces[-1].rstrip(' \t\r\n;')
+    pieces.append(' LIMIT ')
+    pieces.append(limit)
+
+
+@lru_cache(maxsize=512)
+def _translate_tsql(query):
+    """T-SQL -> SQLite rewrite, cached per statement text"""
+    for pattern, replacement in _TSQL_REWRITES:
+        query = pattern.sub(replacement, query)
+    if re.search(r"\bTOP\b", query, re.I):
+        return _relocate_top(query)
+    return query, None
+
+
+class SQLiteDialect(Dialect):
+    """Embedded SQLite file in WAL mode, for local runs, benchmarks and single-node deployments"""
+    name = 'sqlite'
+    Error = sqlite3.Error
+    # SQLite 3.32+ raised the bind limit from 999 to 32766
+    max_params = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+    # The sqlite3 module only opens a transaction before DML, so DDL ahead of it autocommits
+    begin_statement = 'BEGIN'
+
+    def __init__(self, path, busy_timeout=30):
+        self.path = path
+        self.busy_timeout = busy_timeout
+
+    def connect(self):
+        # Pooled connections move between threads, but only one thread uses each at a time
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout,
+                               detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def translate(self, query, params=None):
+        query, order = _translate_tsql(query)
+        if order is not None and params:
+            params = [params[i] for i in order]
+        return query, params
+
+    def returning(self, query, column='id'):
+        return f"{query.rstrip().rstrip(';')} RETURNING {column}"
+
+
+def create_dialect(config=Config):
+    """Pick the database backend named by DATABASE_BACKEND in the config"""
+    backend = (config.DATABASE_BACKEND or 'mssql').lower()
+    if backend == 'sqlite':
+        uri = config.SQLALCHEMY_DATABASE_URI
+        path = uri[len('sqlite:///'):] if uri.startswith('sqlite:///') else 'proestate.db'
+        if path != ':memory:' and not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+        return SQLiteDialect(path)
+    if backend == 'mssql':
+        return SQLServerDialect(config.MSSQL_CONNECTION_STRING)
+    raise Exception(f"Unknown database backend: {config.DATABASE_BACKEND}")
+
+
+_SQL_LITERAL_RE = re.compile(r"N?'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+@lru_cache(maxsize=1024)
+def normalize_sql(query):
+    """Reduce a statement to its shape: literals become ?, IN lists and whitespace collapse"""
+    shape = _SQL_LITERAL_RE.sub('?', ' '.join(query.split()))
+    return _SQL_LIST_RE.sub('(?)', shape)
+
+
+_SQL_TABLE = r"((?:\[?\w+\]?\.)*\[?\w+\]?)"
+_READ_TABLES_RE = re.compile(r"\b(?:FROM|JOIN)\s+" + _SQL_TABLE, re.IGNORECASE)
+_WRITE_TABLE_RE = re.compile(
+    r"^\s*(?:INSERT\s+(?:INTO\s+)?|UPDATE\s+(?:TOP\s*\(\s*\d+\s*\)\s+)?|"
+    r"DELETE\s+(?:TOP\s*\(\s*\d+\s*\)\s+)?(?:FROM\s+)?|MERGE\s+(?:INTO\s+)?|TRUNCATE\s+TABLE\s+)" + _SQL_TABLE,
+    re.IGNORECASE)
+# Where the statement after a WITH clause's last CTE starts, if it is a write
+_CTE_WRITE_RE = re.compile(r"\)\s*(?=(?:INSERT|UPDATE|DELETE|MERGE)\b)", re.IGNORECASE)
+
+
+def _table_name(name):
+    return name.split('.')[-1].strip('[]').lower()
+
+
+@lru_cache(maxsize=1024)
+def canonical_sql(query):
+    """The statement with whitespace collapsed, so layout doesn't split cache keys"""
+    return ' '.join(query.split())
+
+
+@lru_cache(maxsize=1024)
+def read_tables(query):
+    """Tables a SELECT reads from, lower-cased and without schema"""
+    return tuple(sorted({_table_name(name) for name in _READ_TABLES_RE.findall(query)}))
+
+
+@lru_cache(maxsize=1024)
+def written_table(query):
+    """Table a statement writes: None for reads, '*' when it can't be told (DDL, procedures)"""
+    head = query.lstrip()[:6].upper()
+    if head == 'SELECT':
+        return None
+    if head.startswith('WITH'):
+        match = _CTE_WRITE_RE.search(query)
+        if match is None:
+            return None
+        query = query[match.end():]
+    match = _WRITE_TABLE_RE.match(query)
+    return _table_name(match.group(1)) if match else '*'
+
+
+class QueryStats:
+    """Statements run by one request (or one thread outside requests), with timings"""
+
+    MAX_STATEMENTS = 500
+
+    def __init__(self, label=None):
+        self.label = label
+        self.count = 0
+        self.total_time = 0.0
+        self.statements = []    # [shape, seconds], in execution order, capped
+        self.shapes = {}        # shape -> times run
+        self._current = None
+        self._slow_logged = False
+
+    def record(self, query, elapsed):
+        """Count a new statement, or add fetch time to the last one when query is None"""
+        self.total_time += elapsed
+        if query is None:
+            if self._current is None:
+                return
+            self._current[1] += elapsed
+        else:
+            shape = normalize_sql(query)
+            self.count += 1
+            self.shapes[shape] = self.shapes.get(shape, 0) + 1
+            self._current = [shape, elapsed]
+            self._slow_logged = False
+            if len(self.statements) < self.MAX_STATEMENTS:
+                self.statements.append(self._current)
+        self._check_slow()
+
+    def _check_slow(self):
+        shape, seconds = self._current
+        if self._slow_logged or seconds * 1000 < Config.DB_SLOW_QUERY_MS:
+            return
+        self._slow_logged = True
+        logger.warning("Slow query (%.1f ms)%s: %s", seconds * 1000,
+                       f" in {self.label}" if self.label else "", shape)
+
+    def repeated(self, threshold=None):
+        """Shapes run at least threshold times, most frequent first (likely N+1 loops)"""
+        threshold = threshold or Config.DB_N_PLUS_ONE_THRESHOLD
+        return sorted(((shape, n) for shape, n in self.shapes.items() if n >= threshold),
+                      key=lambda item: -item[1])
+
+
+class Cursor:
+    """Cursor wrapper that rewrites every statement for the active dialect"""
+
+    def __init__(self, raw, dialect, observer=None):
+        self.raw = raw
+        self.dialect = dialect
+        # Called with (query, seconds) after each statement and (None, seconds) after each fetch
+        self.observer = observer
+
+    def _timed(self, query, call, *args):
+        if self.observer is None:
+            return call(*args)
+        start = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            self.observer(query, time.perf_counter() - start)
+
+    def execute(self, query, params=None):
+        sql, params = self.dialect.translate(query, params)
+        if params:
+            self._timed(query, self.raw.execute, sql, params)
+        else:
+            self._timed(query, self.raw.execute, sql)
+        return self
+
+    def executemany(self, query, seq_of_params):
+        rows = [self.dialect.translate(query, params)[1] for params in seq_of_params]
+        self._timed(query, self.raw.executemany, self.dialect.translate(query)[0], rows)
+        return self
+
+    def fetchone(self):
+        return self._timed(None, self.raw.fetchone)
+
+    def fetchall(self):
+        return self._timed(None, self.raw.fetchall)
+
+    def fetchmany(self, size=None):
+        if size:
+            return self._timed(None, self.raw.fetchmany, size)
+        return self._timed(None, self.raw.fetchmany)
+
+    @property
+    def rowcount(self):
+        return self.raw.rowcount
+
+    @property
+    def description(self):
+        return self.raw.description
+
+    def close(self):
+        self.raw.close()
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+class BufferedCursor:
+    """Rows that were already fetched, behind the cursor interface callers expect"""
+
+    def __init__(self, rows, description=None):
+        self._rows = rows
+        self._pos = 0
+        self.description = description
+        self.rowcount = len(rows)
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        self._pos += 1
+        return self._rows[self._pos - 1]
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def fetchmany(self, size=1):
+        rows = self._rows[self._pos:self._pos + size]
+        self._pos += len(rows)
+        return rows
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+class PooledConnection:
+    """A raw database connection plus the bookkeeping the pool needs"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        # Set once a statement has run outside of a committed transaction
+        self.dirty = False
+
+    def cursor(self):
+        return self.raw.cursor()
+
+    def commit(self):
+        self.raw.commit()
+        self.dirty = False
+
+    def rollback(self):
+        self.raw.rollback()
+        self.dirty = False
+
+    def close(self):
+        self.raw.close()
+
+
+class ConnectionPool:
+    """Bounded pool of database connections shared by all request threads"""
+
+    def __init__(self, connect, max_size=10, timeout=30, recycle=1800, ping_after=30,
+                 ping_query='SELECT 1'):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self.ping_query = ping_query
+        self._idle = deque()
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {
+            'created': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'recycled': 0,
+            'pings': 0,
+            'stale': 0,
+        }
+
+    def acquire(self):
+        """Check a connection out of the pool, opening one if there is room"""
+        deadline = time.monotonic() + self.timeout
+        waited_since = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise Exception("Database connection pool is closed")
+                if self._idle:
+                    # LIFO keeps the warmest connections busy and lets the rest age out
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise Exception(
+                        f"Timed out after {self.timeout}s waiting for a database connection "
+                        f"(pool size {self.max_size})"
+                    )
+                if waited_since is None:
+                    waited_since = time.monotonic()
+                    self._stats['waits'] += 1
+                self._cond.wait(remaining)
+            if waited_since is not None:
+                self._stats['wait_time'] += time.monotonic() - waited_since
+
+        try:
+            conn = self._open() if conn is None else self._validate(conn)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._in_use += 1
+            self._stats['checkouts'] += 1
+        return conn
+
+    def release(self, conn):
+        """Return a checked-out connection to the pool"""
+        healthy = True
+        if conn.dirty:
+            # Never hand the next borrower someone else's half-finished transaction
+            try:
+                conn.rollback()
+            except Exception:
+                healthy = False
+
+        with self._cond:
+            self._in_use -= 1
+            if healthy and not self._closed:
+                conn.last_used = time.monotonic()
+                self._idle.append(conn)
+                self._cond.notify()
+                return
+        self._discard(conn)
+
+    def _open(self):
+        conn = PooledConnection(self._connect())
+        with self._cond:
+            self._stats['created'] += 1
+        return conn
+
+    def _validate(self, conn):
+        """Recycle connections past their lifetime and ping ones that sat idle too long"""
+        now = time.monotonic()
+        if self.recycle and now - conn.created_at > self.recycle:
+            self._close_raw(conn)
+            with self._cond:
+                self._stats['recycled'] += 1
+            return self._open()
+
+        if self.ping_after is not None and now - conn.last_used > self.ping_after:
+            with self._cond:
+                self._stats['pings'] += 1
+            try:
+                cursor = conn.cursor()
+                cursor.execute(self.ping_query)
+                cursor.fetchall()
+                cursor.close()
+            except Exception:
+                self._close_raw(conn)
+                with self._cond:
+                    self._stats['stale'] += 1
+                return self._open()
+        return conn
+
+    def _discard(self, conn):
+        self._close_raw(conn)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _close_raw(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._stats['closed'] += 1
+
+    def stats(self):
+        """Snapshot of pool counters and current occupancy"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+            })
+        return stats
+
+    def close(self):
+        """Close idle connections; checked-out ones are closed when returned"""
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_raw(conn)
+
 
 class DatabaseConnection:
-    def __init__(self):
-        # SQL Server connection string with correct ODBC driver
-        self.connection_string = (
-            'DRIVER={ODBC Driver 17 for SQL Server};'
-            'SERVER=localhost\\SQLEXPRESS;'
-            'DATABASE=ProEstate;'
-            'Trusted_Connection=yes;'
+    def __init__(self, connection_string=None, pool_size=None, dialect=None, cache_backend=None):
+        # An explicit connection string means SQL Server; otherwise follow the config
+        if dialect is None:
+            dialect = SQLServerDialect(connection_string) if connection_string else create_dialect()
+        self.dialect = dialect
+        self.pool = ConnectionPool(
+            self._connect,
+            max_size=pool_size or Config.DB_POOL_SIZE,
+            timeout=Config.DB_POOL_TIMEOUT,
+            recycle=Config.DB_POOL_RECYCLE,
+            ping_after=Config.DB_POOL_PING_AFTER,
+            ping_query=dialect.ping_query,
         )
-        self.conn = None
-        self.cursor = None
-        self._connect()
+        # Connection currently checked out by each thread
+        self._local = threading.local()
+        # Identical reads running at the same time share one execution
+        self.coalesce_reads = Config.DB_COALESCE_READS
+        self.coalesce_timeout = Config.DB_COALESCE_TIMEOUT
+        self.flight = SingleFlight()
+        # Commits that wrote something; part of every read's flight key
+        self._commits = 0
+        self._commits_lock = threading.Lock()
+        # Results of reads that opt in with cache_ttl, dropped when a commit writes a table they read
+        self.query_cache = TaggedCache('query', max_entries=Config.QUERY_CACHE_MAX_ENTRIES,
+                                       max_bytes=Config.QUERY_CACHE_MAX_BYTES,
+                                       backend=cache_backend) if Config.QUERY_CACHE_ENABLED else None
+        self.query_cache_max_rows = Config.QUERY_CACHE_MAX_ROWS
 
     def _connect(self):
-        """Establish database connection and create cursor"""
+        """Open a new raw database connection for the pool"""
         try:
-            self.conn = pyodbc.connect(self.connection_string)
-            self.cursor = self.conn.cursor()
-        except pyodbc.Error as e:
+            return self.dialect.connect()
+        except self.dialect.Error as e:
             raise Exception(f"Failed to connect to database: {str(e)}")
 
-    def fetch_all(self, query, params=None):
+    def _state(self):
+        local = self._local
+        if not hasattr(local, 'conn'):
+            local.conn = None
+            local.refs = 0
+            local.tx_depth = 0
+            local.pinned = False
+            local.uncommitted = False
+            # Tables written since this thread's last commit or rollback
+            local.written = set()
+            local.stats = QueryStats()
+        return local
+
+    def _checkout(self):
+        """Return the connection bound to this thread, checking one out if needed"""
+        state = self._state()
+        if state.conn is None:
+            state.conn = self.pool.acquire()
+        return state.conn
+
+    def _checkin(self):
+        """Give this thread's connection back unless something still needs it"""
+        state = self._state()
+        # Uncommitted writes from execute() live on this connection until commit() or rollback()
+        if state.conn is None or state.refs > 0 or state.tx_depth > 0 or state.pinned or state.uncommitted:
+            return
+        conn, state.conn = state.conn, None
+        self.pool.release(conn)
+
+    def _cursor(self, conn):
+        state = self._state()
+
+        def observe(query, elapsed):
+            state.stats.record(query, elapsed)
+            if query is not None:
+                table = written_table(query)
+                if table is not None:
+                    state.written.add(table)
+
+        return Cursor(conn.cursor(), self.dialect, observe)
+
+    def _committed(self, state):
+        """Drop cached results that read a table this thread's commit has changed"""
+        written, state.written = state.written, set()
+        if not written:
+            return
+        with self._commits_lock:
+            self._commits += 1
+        if self.query_cache is None:
+            return
+        if '*' in written:
+            self.query_cache.clear()
+        else:
+            self.query_cache.invalidate(*written)
+
+    def _run(self, conn, query, params=None):
+        cursor = self._cursor(conn)
+        try:
+            cursor.execute(query, params)
+        except Exception:
+            cursor.close()
+            raise
+        conn.dirty = True
+        return cursor
+
+    def _shareable(self, query):
+        # A thread with its own uncommitted writes must read them, not someone else's result
+        state = self._state()
+        return state.tx_depth == 0 and not state.uncommitted and query.lstrip()[:6].upper() == 'SELECT'
+
+    def _read(self, query, params, cache_ttl=None):
+        """(rows, description) of a read; concurrent identical reads wait for one execution,
+        and with cache_ttl the result is kept for later ones"""
+        try:
+            key = (canonical_sql(query), tuple(params) if params else ())
+            hash(key)
+        except TypeError:
+            return self._fetch(query, params)
+        if not cache_ttl or self.query_cache is None:
+            return self._coalesced(key, lambda: self._fetch(query, params))
+
+        result = self.query_cache.get(key)
+        if result is None:
+            tables = read_tables(query)
+
+            def fetch():
+                # Versions from before this execution, which every read sharing it stores under
+                return self.query_cache.versions(tables), self._fetch(query, params)
+
+            versions, result = self._coalesced(('cache', key), fetch)
+            if len(result[0]) <= self.query_cache_max_rows:
+                self.query_cache.set(key, result, tables, versions, cache_ttl)
+        return result
+
+    def _coalesced(self, key, fetch):
+        if not self.coalesce_reads:
+            return fetch()
+        # A read that started before the latest commit may return rows from before it; don't join it
+        return self.flight.do((key, self._commits), fetch, self.coalesce_timeout)
+
+    def _fetch(self, query, params):
+        state = self._state()
+        conn = self._checkout()
+        state.refs += 1
+        try:
+            cursor = self._run(conn, query, params)
+            rows = [tuple(row) for row in cursor.fetchall()]
+            description = cursor.description
+            cursor.close()
+            return rows, description
+        finally:
+            state.refs -= 1
+            self._checkin()
+
+    def _fail(self, message, error):
+        self.rollback()
+        raise Exception(f"{message}: {str(error)}")
+
+    def begin_request(self, label=None):
+        """Keep one connection for the whole request once it is first needed, and start
+        counting its statements"""
+        state = self._state()
+        state.pinned = True
+        state.stats = QueryStats(label)
+
+    def request_stats(self):
+        """Query count, DB time and statement shapes recorded since begin_request()"""
+        return self._state().stats
+
+    def end_request(self):
+        """Return the request's connection to the pool, discarding unfinished work"""
+        state = self._state()
+        stats, state.stats = state.stats, QueryStats()
+        # Outside a request (scripts, close()) a loop of inserts is just a loop
+        if state.pinned:
+            for shape, count in stats.repeated():
+                logger.warning("Possible N+1%s: %d x %s", f" in {stats.label}" if stats.label else "",
+                               count, shape)
+        state.pinned = False
+        state.refs = 0
+        state.tx_depth = 0
+        state.uncommitted = False
+        state.written = set()
+        if state.conn is not None:
+            conn, state.conn = state.conn, None
+            self.pool.release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Run a block of statements on one connection and commit them together"""
+        state = self._state()
+        conn = self._checkout()
+        state.tx_depth += 1
+        cursor = self._cursor(conn)
+        try:
+            yield cursor
+            if state.tx_depth == 1:
+                conn.commit()
+                self._committed(state)
+        except Exception:
+            if state.tx_depth == 1:
+                conn.rollback()
+                state.written = set()
+            raise
+        finally:
+            cursor.close()
+            state.tx_depth -= 1
+            self._checkin()
+
+    def fetch_all(self, query, params=None, cache_ttl=None):
         """Execute query and return all rows"""
+        state = self._state()
         try:
-            if params:
-                self.cursor.execute(query, params)
-            else:
-                self.cursor.execute(query)
-            return self.cursor.fetchall()
-        except pyodbc.Error as e:
-            self.rollback()
-            raise Exception(f"Database query error: {str(e)}")
+            if self._shareable(query):
+                return self._read(query, params, cache_ttl)[0]
+            conn = self._checkout()
+            state.refs += 1
+            try:
+                cursor = self._run(conn, query, params)
+                rows = cursor.fetchall()
+                cursor.close()
+                return rows
+            finally:
+                state.refs -= 1
+                self._checkin()
+        except self.dialect.Error as e:
+            self._fail("Database query error", e)
 
-    def fetch_one(self, query, params=None):
+    def fetch_one(self, query, params=None, cache_ttl=None):
         """Execute query and return first row"""
+        state = self._state()
         try:
-            if params:
-                self.cursor.execute(query, params)
-            else:
-                self.cursor.execute(query)
-            return self.cursor.fetchone()
-        except pyodbc.Error as e:
-            self.rollback()
-            raise Exception(f"Database query error: {str(e)}")
+            if self._shareable(query):
+                rows = self._read(query, params, cache_ttl)[0]
+                return rows[0] if rows else None
+            conn = self._checkout()
+            state.refs += 1
+            try:
+                cursor = self._run(conn, query, params)
+                row = cursor.fetchone()
+                cursor.close()
+                return row
+            finally:
+                state.refs -= 1
+                self._checkin()
+        except self.dialect.Error as e:
+            self._fail("Database query error", e)
 
     def execute(self, query, params=None):
-        """Execute a query (INSERT, UPDATE, DELETE)"""
+        """Execute a query (INSERT, UPDATE, DELETE) in a transaction left open until commit()"""
         try:
-            if params:
-                self.cursor.execute(query, params)
-            else:
-                self.cursor.execute(query)
-            return self.cursor
-        except pyodbc.Error as e:
-            self.rollback()
-            raise Exception(f"Database execution error: {str(e)}")
+            conn = self._checkout()
+            cursor = self._run(conn, query, params)
+            self._state().uncommitted = True
+            return cursor
+        except self.dialect.Error as e:
+            self._fail("Database execution error", e)
+
+    def begin(self):
+        """Start a transaction that schema changes are part of too, left open until commit()"""
+        if self.dialect.begin_statement:
+            self.execute(self.dialect.begin_statement)
 
     def commit(self):
         """Commit current transaction"""
+        state = self._state()
         try:
-            if self.conn:
-                self.conn.commit()
-        except pyodbc.Error as e:
+            if state.conn:
+                state.conn.commit()
+            state.uncommitted = False
+            self._committed(state)
+        except self.dialect.Error as e:
             raise Exception(f"Database commit error: {str(e)}")
+        finally:
+            self._checkin()
 
     def rollback(self):
         """Rollback current transaction"""
+        state = self._state()
         try:
-            if self.conn:
-                self.conn.rollback()
-        except pyodbc.Error as e:
+            if state.conn:
+                state.conn.rollback()
+            state.uncommitted = False
+            state.written = set()
+        except self.dialect.Error as e:
             raise Exception(f"Database rollback error: {str(e)}")
+        finally:
+            self._checkin()
+
+    def execute_query(self, query, params=None, cache_ttl=None):
+        """Execute a query and return (conn, cursor); pass both to close_connection() when done.
 
-    def execute_query(self, query, params=None):
-        """Execute a query and return cursor (legacy method for compatibility)"""
+        With cache_ttl (seconds) a SELECT's rows may be served from, and kept
+        in, the query cache; any commit that writes a table the query reads
+        drops them.
+        """
+        state = self._state()
         try:
-            if params:
-                self.cursor.execute(query, params)
-            else:
-                self.cursor.execute(query)
-            return self.conn, self.cursor
-        except pyodbc.Error as e:
-            self.rollback()
-            raise Exception(f"Database query error: {str(e)}")
+            if self._shareable(query):
+                rows, description = self._read(query, params, cache_ttl)
+                # Balanced by close_connection(), like a query that held the connection
+                state.refs += 1
+                return state.conn, BufferedCursor(rows, description)
+            conn = self._checkout()
+            state.refs += 1
+            try:
+                return conn, self._run(conn, query, params)
+            except Exception:
+                state.refs -= 1
+                raise
+        except self.dialect.Error as e:
+            self._fail("Database query error", e)
 
     def execute_non_query(self, query, params=None):
-        """Execute a non-query (INSERT, UPDATE, DELETE) (legacy method for compatibility)"""
-        try:
-            if params:
-                self.cursor.execute(query, params)
-            else:
-                self.cursor.execute(query)
-            self.commit()
-            return self.conn, self.cursor
-        except pyodbc.Error as e:
-            self.rollback()
-            raise Exception(f"Database execution error: {str(e)}")
+        """Execute and commit a non-query (INSERT, UPDATE, DELETE); returns (conn, cursor)"""
+        state = self._state()
+        try:
+            conn = self._checkout()
+            state.refs += 1
+            try:
+                cursor = self._run(conn, query, params)
+                if state.tx_depth == 0:
+                    conn.commit()
+                    self._committed(state)
+                return conn, cursor
+            except Exception:
+                state.refs -= 1
+                raise
+        except self.dialect.Error as e:
+            self._fail("Database execution error", e)
+
+    def insert_returning_id(self, query, params=None, id_column='id'):
+        """Run an INSERT and return the new row's id from the same statement"""
+        state = self._state()
+        try:
+            conn = self._checkout()
+            state.refs += 1
+            try:
+                cursor = self._run(conn, self.dialect.returning(query, id_column), params)
+                rows = cursor.fetchall()
+                cursor.close()
+                if state.tx_depth == 0:
+                    conn.commit()
+                    self._committed(state)
+            finally:
+                state.refs -= 1
+                self._checkin()
+        except self.dialect.Error as e:
+            self._fail("Database execution error", e)
+
+        if not rows or rows[0][0] is None:
+            raise Exception("Insert failed - no ID returned from database")
+        return int(rows[0][0])
+
+    def bulk_insert(self, table, columns, rows, batch_size=1000, return_ids=True, id_column='id'):
+        """Insert many rows, committing once per batch; returns the new ids in input order"""
+        ids = []
+        batch = []
+        for row in rows:
+            batch.append(tuple(row))
+            if len(batch) >= batch_size:
+                ids.extend(self._insert_batch(table, columns, batch, return_ids, id_column))
+                batch = []
+        if batch:
+            ids.extend(self._insert_batch(table, columns, batch, return_ids, id_column))
+        return ids
+
+    def _insert_batch(self, table, columns, batch, return_ids, id_column):
+        try:
+            with self.transaction() as cursor:
+                return self.dialect.insert_many(cursor, table, columns, batch,
+                                                id_column if return_ids else None)
+        except self.dialect.Error as e:
+            raise Exception(f"Database bulk insert error: {str(e)}")
 
     def close_connection(self, conn=None, cursor=None):
-        """Close cursor and connection (legacy method for compatibility)"""
-        # Since we use persistent connection, this is mainly for compatibility
-        pass
+        """Close the cursor and return the connection to the pool"""
+        state = self._state()
+        if cursor is not None:
+            try:
+                cursor.close()
+            except self.dialect.Error:
+                pass
+        if state.refs > 0:
+            state.refs -= 1
+        self._checkin()
+
+    def pool_stats(self):
+        """Pool counters and occupancy, for diagnostics"""
+        return self.pool.stats()
+
+    def coalescing_stats(self):
+        """Reads run, reads served from another thread's identical read (saved), and timeouts"""
+        return self.flight.stats()
+
+    def query_cache_stats(self):
+        """Hit/miss counters of the query cache, or None when it is disabled"""
+        return self.query_cache.stats() if self.query_cache is not None else None
 
     def close(self):
-        """Close the persistent connection"""
+        """Return this thread's connection and close every idle pooled connection"""
         try:
-            if self.cursor:
-                self.cursor.close()
-            if self.conn:
-                self.conn.close()
-        except pyodbc.Error as e:
+            self.end_request()
+            self.pool.close()
+        except self.dialect.Error as e:
             raise Exception(f"Error closing database connection: {str(e)}")
-
-    def __del__(self):
-        """Destructor to ensure connection is closed"""
-        self.close()
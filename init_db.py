@@ -1,24 +1,44 @@
 from models import Property, ContactMessage, User
 from db_utils import DatabaseConnection
+from locations import HIERARCHY, LocationTree
 from datetime import datetime
+import sys
 
-def create_tables():
-    """Create database tables using raw SQL"""
-    db_conn = DatabaseConnection()
+def seed_locations(db_conn):
+    """Fill the locations table from HIERARCHY and file existing listings under it"""
+    for governorate, cities in HIERARCHY:
+        db_conn.execute("INSERT INTO locations (name, level, parent_id) VALUES (?, 'governorate', NULL)",
+                        (governorate,))
+        for city, districts in cities:
+            db_conn.execute(
+                "INSERT INTO locations (name, level, parent_id) "
+                "SELECT ?, 'city', id FROM locations WHERE level = 'governorate' AND name = ?",
+                (city, governorate)
+            )
+            for district in districts:
+                db_conn.execute(
+                    "INSERT INTO locations (name, level, parent_id) "
+                    "SELECT ?, 'district', c.id FROM locations c JOIN locations g ON g.id = c.parent_id "
+                    "WHERE c.level = 'city' AND c.name = ? AND g.name = ?",
+                    (district, city, governorate)
+                )
+
+    file_listings(db_conn)
 
-    # Drop tables if they exist (in reverse order due to foreign keys)
-    drop_queries = [
-        "IF OBJECT_ID('chat_history', 'U') IS NOT NULL DROP TABLE chat_history;",
-        "IF OBJECT_ID('contact_messages', 'U') IS NOT NULL DROP TABLE contact_messages;",
-        "IF OBJECT_ID('favorites', 'U') IS NOT NULL DROP TABLE favorites;",
-        "IF OBJECT_ID('properties', 'U') IS NOT NULL DROP TABLE properties;",
-        "IF OBJECT_ID('users', 'U') IS NOT NULL DROP TABLE users;"
-    ]
+def file_listings(db_conn):
+    """Set every listing's location_id from its free-text location"""
+    tree = LocationTree(db_conn.fetch_all("SELECT id, name, level, parent_id FROM locations"))
+    for (location,) in db_conn.fetch_all("SELECT DISTINCT location FROM properties WHERE location IS NOT NULL"):
+        location_id = tree.normalize(location)
+        db_conn.execute("UPDATE properties SET location_id = ? WHERE location = ?", (location_id, location))
 
-    # Create tables
-    create_queries = [
+# Schema migrations, applied in order and recorded in schema_version. A step is a statement
+# or a function of the connection, for data changes.
+# Never edit a released migration; append a new one instead.
+MIGRATIONS = [
+    (1, "Base tables", [
         """
-        CREATE TABLE users (
+        IF OBJECT_ID('users', 'U') IS NULL CREATE TABLE users (
             id INT IDENTITY(1,1) PRIMARY KEY,
             email NVARCHAR(120) UNIQUE NOT NULL,
             password_hash NVARCHAR(256),
@@ -31,7 +51,7 @@ def create_tables():
         );
         """,
         """
-        CREATE TABLE properties (
+        IF OBJECT_ID('properties', 'U') IS NULL CREATE TABLE properties (
             id INT IDENTITY(1,1) PRIMARY KEY,
             title NVARCHAR(200) NOT NULL,
             description NVARCHAR(MAX) NOT NULL,
@@ -53,7 +73,7 @@ def create_tables():
         );
         """,
         """
-        CREATE TABLE favorites (
+        IF OBJECT_ID('favorites', 'U') IS NULL CREATE TABLE favorites (
             id INT IDENTITY(1,1) PRIMARY KEY,
             user_id INT NOT NULL,
             property_id INT NOT NULL,
@@ -63,7 +83,7 @@ def create_tables():
         );
         """,
         """
-        CREATE TABLE contact_messages (
+        IF OBJECT_ID('contact_messages', 'U') IS NULL CREATE TABLE contact_messages (
             id INT IDENTITY(1,1) PRIMARY KEY,
             name NVARCHAR(100) NOT NULL,
             email NVARCHAR(100) NOT NULL,
@@ -77,7 +97,7 @@ def create_tables():
         );
         """,
         """
-        CREATE TABLE chat_history (
+        IF OBJECT_ID('chat_history', 'U') IS NULL CREATE TABLE chat_history (
             id INT IDENTITY(1,1) PRIMARY KEY,
             user_id INT,
             timestamp DATETIME2 DEFAULT GETDATE(),
@@ -86,32 +106,111 @@ def create_tables():
             FOREIGN KEY (user_id) REFERENCES users(id)
         );
         """
-    ]
+    ]),
+    (2, "Indexes for listing, favorites and chat access paths", [
+        # /properties, homepage featured and get_by_status: WHERE status = ? ORDER BY created_at DESC
+        "CREATE INDEX ix_properties_status_created ON properties (status, created_at DESC, id DESC)",
+        # /properties?type=...: WHERE status = 'available' AND property_type = ? ORDER BY created_at DESC
+        "CREATE INDEX ix_properties_type_status_created "
+        "ON properties (property_type, status, created_at DESC, id DESC)",
+        # /my-properties: WHERE user_id = ? ORDER BY created_at DESC
+        "CREATE INDEX ix_properties_user_created ON properties (user_id, created_at DESC, id DESC)",
+        # A user can favorite a listing once; drop any duplicates before enforcing it
+        "DELETE FROM favorites WHERE id NOT IN (SELECT MIN(id) FROM favorites GROUP BY user_id, property_id)",
+        "CREATE UNIQUE INDEX ux_favorites_user_property ON favorites (user_id, property_id)",
+        # /favorites: WHERE user_id = ? ORDER BY created_at DESC, covering the property id
+        "CREATE INDEX ix_favorites_user_created ON favorites (user_id, created_at DESC) INCLUDE (property_id)",
+        "CREATE INDEX ix_favorites_property ON favorites (property_id)",
+        # Chat context: WHERE user_id = ? ORDER BY timestamp DESC
+        "CREATE INDEX ix_chat_history_user_timestamp ON chat_history (user_id, timestamp DESC)",
+        "CREATE INDEX ix_contact_messages_property ON contact_messages (property_id, created_at DESC)"
+    ]),
+    (3, "Indexes for listing Last-Modified validators", [
+        # Conditional GET on /properties: MAX(updated_at) WHERE status = ? [AND property_type = ?]
+        "CREATE INDEX ix_properties_status_updated ON properties (status, updated_at)",
+        "CREATE INDEX ix_properties_type_status_updated ON properties (property_type, status, updated_at)"
+    ]),
+    (4, "Indexes for listing price and area filters and sorts", [
+        # /properties?sort=price-low|price-high and min_price/max_price: WHERE status = ? ORDER BY price
+        "CREATE INDEX ix_properties_status_price ON properties (status, price, id)",
+        "CREATE INDEX ix_properties_type_status_price ON properties (property_type, status, price, id)",
+        # /properties?sort=area and min_area/max_area: WHERE status = ? ORDER BY area DESC
+        "CREATE INDEX ix_properties_status_area ON properties (status, area DESC, id DESC)",
+        "CREATE INDEX ix_properties_type_status_area ON properties (property_type, status, area DESC, id DESC)"
+    ]),
+    (5, "Locations dimension", [
+        """
+        CREATE TABLE locations (
+            id INT IDENTITY(1,1) PRIMARY KEY,
+            name NVARCHAR(100) NOT NULL,
+            level NVARCHAR(20) NOT NULL,
+            parent_id INT,
+            FOREIGN KEY (parent_id) REFERENCES locations(id)
+        );
+        """,
+        "ALTER TABLE properties ADD location_id INT NULL REFERENCES locations(id)",
+        # /properties?location_id=: WHERE location_id IN (...) AND status = ? ORDER BY created_at DESC
+        "CREATE INDEX ix_properties_location_status ON properties (location_id, status, created_at DESC, id DESC)",
+        seed_locations
+    ]),
+    (6, "Re-file listings under the stricter location normalizer", [
+        file_listings
+    ]),
+]
 
-    try:
-        # Drop existing tables
-        for query in drop_queries:
-            db_conn.execute(query)
+SCHEMA_VERSION_TABLE = """
+IF OBJECT_ID('schema_version', 'U') IS NULL CREATE TABLE schema_version (
+    version INT PRIMARY KEY,
+    description NVARCHAR(200) NOT NULL,
+    applied_at DATETIME2 DEFAULT GETDATE()
+);
+"""
 
-        # Create new tables
-        for query in create_queries:
-            db_conn.execute(query)
+def get_schema_version(db_conn):
+    """Highest migration version applied to the database"""
+    row = db_conn.fetch_one("SELECT MAX(version) FROM schema_version")
+    return (row[0] or 0) if row else 0
 
+def migrate():
+    """Apply pending schema migrations without touching existing data"""
+    db_conn = DatabaseConnection()
+
+    try:
+        db_conn.execute(SCHEMA_VERSION_TABLE)
         db_conn.commit()
-        print("✅ Database tables created successfully!")
+
+        current = get_schema_version(db_conn)
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            # Each migration commits together with its schema_version row
+            db_conn.begin()
+            for step in statements:
+                if callable(step):
+                    step(db_conn)
+                else:
+                    db_conn.execute(step)
+            db_conn.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, datetime.utcnow())
+            )
+            db_conn.commit()
+            print(f"✅ Applied migration {version}: {description}")
+
+        print(f"✅ Database schema is at version {get_schema_version(db_conn)}")
         return True
 
     except Exception as e:
         db_conn.rollback()
-        print(f"❌ Error creating tables: {str(e)}")
+        print(f"❌ Error migrating database: {str(e)}")
         return False
     finally:
         db_conn.close()
 
 def init_database():
     try:
-        # Create tables
-        if not create_tables():
+        # Bring the schema up to date
+        if not migrate():
             return False
 
         # Create sample user
@@ -300,11 +399,13 @@ def init_database():
             }
         ]
 
+        # Only seed listings into an empty database
+        if Property.get_all_paginated(page=1, per_page=1).total:
+            print("ℹ️ Properties already exist, skipping sample data")
+            return True
+
         # Create properties
-        created_properties = []
-        for prop_data in sample_properties_data:
-            prop = Property.create(**prop_data)
-            created_properties.append(prop)
+        created_properties = Property.create_many(sample_properties_data)
 
         print(f"✅ {len(created_properties)} sample properties created successfully!")
 
@@ -329,6 +430,10 @@ def init_database():
         return False
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['migrate']:
+        # Schema changes only, no sample data
+        sys.exit(0 if migrate() else 1)
+
     print("🔄 Initializing ProEstate Database...")
     success = init_database()
     if success:
@@ -0,0 +1,308 @@
+"""In-memory column store of listings for Property.get_available.
+
+Each listing is one slot across NumPy column arrays (id, created_at, price,
+area, bedrooms, bathrooms, location id, type and location codes,
+availability). A query is a vectorised mask over the columns. A narrow
+filter then partially sorts just its matches up to the requested page; a
+broad one walks a presorted order of every available listing until the page
+is full. Either way the cost depends on CPU rather than on round trips to
+the database. Masks for a type or location filter (in an LRU capped by
+size) and the presorted orders are built on first use and kept until the
+next write. The index is built once from the database and then kept current
+by upsert()/remove().
+"""
+import threading
+from datetime import datetime, timedelta
+from cache import LRUCache
+
+try:
+    import numpy as np
+except ImportError:  # Without NumPy, get_available keeps using SQL
+    np = None
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def index_row(prop):
+    """The fields of a Property the index needs, as a picklable tuple"""
+    return (prop.id, prop.property_type, prop.location, prop.price, prop.area, prop.bedrooms,
+            prop.bathrooms, prop.status, prop.created_at, prop.location_id)
+
+
+def _micros(value):
+    """created_at as integer microseconds, which keep equal timestamps equal"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value is None:
+        return 0
+    return (value.replace(tzinfo=None) - EPOCH) // timedelta(microseconds=1)
+
+
+class ListingIndex:
+    """Column arrays of every listing, queried with vectorised filters"""
+
+    def __init__(self, rows, max_masks=256, mask_bytes=64 * 1024 * 1024):
+        self._lock = threading.RLock()
+        self._capacity = 0
+        self._size = 0
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._columns = {
+            'created_at': np.zeros(0, dtype=np.int64),
+            'price': np.zeros(0),
+            'area': np.zeros(0),
+            'bedrooms': np.zeros(0, dtype=np.int32),
+            'bathrooms': np.zeros(0, dtype=np.int32),
+            'location_id': np.zeros(0, dtype=np.int32),
+        }
+        self._types = np.zeros(0, dtype=np.int32)
+        self._locations = np.zeros(0, dtype=np.int32)
+        self._available = np.zeros(0, dtype=bool)
+        self._slots = {}            # property id -> slot
+        self._type_codes = {}       # property_type -> code
+        self._location_codes = {}   # location -> code
+        # ('type'|'location'|'location_ids', value) -> bool array over slots, and ('within', id) ->
+        # _within() entries; each is as long as the index, so they are capped by size too
+        self._masks = LRUCache('listing_masks', max_entries=max_masks, ttl=3600, max_bytes=mask_bytes)
+        self._orders = {}           # (column, descending) -> _order() arrays
+
+        self._grow(len(rows))
+        if rows:
+            ids, types, locations, prices, areas, bedrooms, bathrooms, statuses, created, places = zip(*rows)
+            size = self._size = len(rows)
+            self._slots = dict(zip(ids, range(size)))
+            self._ids[:size] = ids
+            self._columns['created_at'][:size] = [_micros(value) for value in created]
+            self._columns['price'][:size] = [float(value or 0) for value in prices]
+            self._columns['area'][:size] = [float(value or 0) for value in areas]
+            self._columns['bedrooms'][:size] = [value or 0 for value in bedrooms]
+            self._columns['bathrooms'][:size] = [value or 0 for value in bathrooms]
+            self._columns['location_id'][:size] = [value or 0 for value in places]
+            self._types[:size] = [self._code(self._type_codes, value) for value in types]
+            self._locations[:size] = [self._code(self._location_codes, value) for value in locations]
+            self._available[:size] = [status == 'available' for status in statuses]
+
+    def __len__(self):
+        return len(self._slots)
+
+    @staticmethod
+    def _code(codes, value):
+        return codes.setdefault(value or '', len(codes))
+
+    def _grow(self, needed):
+        if needed <= self._capacity:
+            return
+        capacity = max(needed, self._capacity * 2, 1024)
+        extra = capacity - self._capacity
+
+        def grown(array):
+            return np.concatenate([array, np.zeros(extra, dtype=array.dtype)])
+
+        self._ids = grown(self._ids)
+        self._columns = {name: grown(column) for name, column in self._columns.items()}
+        self._types = grown(self._types)
+        self._locations = grown(self._locations)
+        self._available = grown(self._available)
+        self._capacity = capacity
+
+    def upsert(self, rows):
+        """Add or refresh listings given as index_row() tuples"""
+        with self._lock:
+            for (prop_id, property_type, location, price, area, bedrooms, bathrooms, status, created,
+                 location_id) in rows:
+                slot = self._slots.get(prop_id)
+                if slot is None:
+                    self._grow(self._size + 1)
+                    slot = self._size
+                    self._size += 1
+                    self._slots[prop_id] = slot
+                self._ids[slot] = prop_id
+                self._columns['created_at'][slot] = _micros(created)
+                self._columns['price'][slot] = float(price or 0)
+                self._columns['area'][slot] = float(area or 0)
+                self._columns['bedrooms'][slot] = bedrooms or 0
+                self._columns['bathrooms'][slot] = bathrooms or 0
+                self._columns['location_id'][slot] = location_id or 0
+                self._types[slot] = self._code(self._type_codes, property_type)
+                self._locations[slot] = self._code(self._location_codes, location)
+                self._available[slot] = status == 'available'
+            self._masks.clear()
+            self._orders.clear()
+
+    def remove(self, prop_ids):
+        with self._lock:
+            for prop_id in prop_ids:
+                slot = self._slots.pop(prop_id, None)
+                if slot is not None:
+                    self._available[slot] = False
+            self._masks.clear()
+            self._orders.clear()
+
+    def _mask(self, kind, value):
+        key = (kind, value)
+        mask = self._masks.get(key)
+        if mask is None:
+            size = self._size
+            if kind == 'type':
+                code = self._type_codes.get(value)
+                mask = self._types[:size] == code if code is not None else np.zeros(size, dtype=bool)
+            elif kind == 'location_ids':
+                mask = np.isin(self._columns['location_id'][:size], value)
+            else:
+                # Substring match without regard to case, like the SQL LIKE '%...%' it replaces
+                needle = value.lower()
+                codes = [code for location, code in self._location_codes.items() if needle in location.lower()]
+                mask = np.isin(self._locations[:size], codes)
+            self._masks.set(key, mask)
+        return mask
+
+    def _within(self, within):
+        """(mask, score per slot) of (ids, scores) search results, kept until the next write"""
+        key = ('within', id(within))
+        entry = self._masks.get(key)
+        # The results are kept in the entry too, so the id can't be reused while it lives
+        if entry is None or entry[0] is not within:
+            size = self._size
+            # Line each slot up with its entry in the sorted ids, if it has one
+            order = np.argsort(within[0])
+            wanted = within[0][order]
+            position = np.minimum(np.searchsorted(wanted, self._ids[:size]), len(wanted) - 1)
+            found = wanted[position] == self._ids[:size]
+            entry = (within, found, np.where(found, within[1][order][position], 0.0))
+            self._masks.set(key, entry)
+        return entry[1], entry[2]
+
+    def _order(self, column, descending):
+        """(slots, keys, ties) of available listings sorted ascending on (keys, ties).
+
+        A descending order negates both. Built on first use and kept until
+        the next write.
+        """
+        order_key = (column, descending)
+        order = self._orders.get(order_key)
+        if order is None:
+            slots = np.flatnonzero(self._available[:self._size])
+            sign = -1 if descending else 1
+            keys = self._columns[column][slots] * sign
+            ties = self._ids[slots] * sign
+            order = np.lexsort((ties, keys))
+            order = self._orders[order_key] = (slots[order], keys[order], ties[order])
+        return order
+
+    @staticmethod
+    def _scan(slots, mask, start, count, forward=True):
+        """Up to count of the sorted slots that pass mask, from start onwards or before it.
+
+        Reads the slots in growing chunks, so a page of a broad filter only
+        touches the first few thousand entries.
+        """
+        found = []
+        chunk = max(count * 4, 1024)
+        position = start
+        while count > 0 and (position < len(slots) if forward else position > 0):
+            if forward:
+                part = slots[position:position + chunk]
+                position += chunk
+            else:
+                part = slots[max(position - chunk, 0):position]
+                position -= chunk
+            hits = part[mask[part]]
+            if forward:
+                hits = hits[:count]
+                found.append(hits)
+            else:
+                hits = hits[max(len(hits) - count, 0):]
+                found.insert(0, hits)
+            count -= len(hits)
+            chunk *= 2
+        return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+    def search(self, property_type='', location='', min_price=None, max_price=None, min_area=None,
+               max_area=None, bedrooms=None, bathrooms=None, column='created_at', descending=True,
+               offset=0, limit=5, after=None, within=None, location_ids=None):
+        """(ids of one page, total matches) for available listings matching the filters.
+
+        Listings are ordered on (column, id), both descending or both
+        ascending. `after` is (forward, key, id) of a boundary listing: the
+        page then starts just past it, or ends just before it when not forward.
+        `within` is (ids, scores), e.g. text search results: only those
+        listings match, and a column of None orders them by score.
+        location_ids limits the listings to those filed under these locations.
+        """
+        if within is not None and not len(within[0]):
+            return [], 0
+        sign = -1 if descending else 1
+        if after is not None:
+            forward, key, prop_id = after
+            if column == 'created_at':
+                key = _micros(key)
+            key, prop_id = key * sign, prop_id * sign
+            offset = 0
+        end = offset + limit
+
+        with self._lock:
+            size = self._size
+            mask = self._available[:size].copy()
+            if property_type:
+                mask &= self._mask('type', property_type)
+            if location:
+                mask &= self._mask('location', location)
+            if location_ids is not None:
+                mask &= self._mask('location_ids', tuple(location_ids))
+            for name, low, high in (('price', min_price, max_price), ('area', min_area, max_area),
+                                    ('bedrooms', bedrooms, None), ('bathrooms', bathrooms, None)):
+                values = self._columns[name][:size]
+                if low is not None:
+                    mask &= values >= low
+                if high is not None:
+                    mask &= values <= high
+            if within is not None:
+                found, relevance = self._within(within)
+                mask &= found
+            total = int(np.count_nonzero(mask))
+
+            if column is not None and end * size <= total * total:
+                # Broad filter: walk the presorted order until the page is full
+                slots, keys, ties = self._order(column, descending)
+                if after is None:
+                    page = self._scan(slots, mask, 0, end)[offset:]
+                else:
+                    low = np.searchsorted(keys, key, 'left')
+                    high = np.searchsorted(keys, key, 'right')
+                    side = 'right' if forward else 'left'
+                    start = low + np.searchsorted(ties[low:high], prop_id, side)
+                    page = self._scan(slots, mask, start, limit, forward)
+                return [int(prop_id) for prop_id in self._ids[page]], total
+
+            # Narrow filter: sort just the matches
+            slots = np.flatnonzero(mask)
+            ids = self._ids[slots]
+            keys = (relevance if column is None else self._columns[column])[slots] * sign
+            ties = ids * sign
+
+        reverse = False
+        if after is not None:
+            if forward:
+                beyond = (keys > key) | ((keys == key) & (ties > prop_id))
+            else:
+                # Walk backwards: flip the order, take the first page, then flip the page back
+                beyond = (keys < key) | ((keys == key) & (ties < prop_id))
+                keys, ties, reverse = -keys, -ties, True
+            ids, keys, ties = ids[beyond], keys[beyond], ties[beyond]
+
+        if end < len(ids):
+            # Keep only keys up to the end-th smallest; ties at the cut stay for the exact sort
+            cut = np.partition(keys, end - 1)[end - 1]
+            near = keys <= cut
+            ids, keys, ties = ids[near], keys[near], ties[near]
+        order = np.lexsort((ties, keys))[offset:end]
+        page = [int(prop_id) for prop_id in ids[order]]
+        if reverse:
+            page.reverse()
+        return page, total
+
+    def stats(self):
+        with self._lock:
+            return {'listings': len(self._slots), 'available': int(self._available[:self._size].sum()),
+                    'slots': self._size, 'capacity': self._capacity, 'masks': len(self._masks),
+                    'mask_bytes': self._masks.stats()['bytes'],
+                    'orders': len(self._orders)}
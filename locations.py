@@ -0,0 +1,149 @@
+"""The governorate -> city -> district hierarchy listings are filed under.
+
+Listings keep the free-text location they were entered with ("New Cairo,
+Cairo", "Katameya Heights, New Cairo", "6th of October City"); normalize()
+maps such a string onto the most specific place it names, using the same
+spelling folding as the text search, and the listing stores that place's id
+in properties.location_id. Filtering on a place is then an integer lookup
+on it and everything under it.
+"""
+from collections import namedtuple
+from search import tokenize
+
+LEVELS = ('governorate', 'city', 'district')
+# Words that don't tell places apart; a name is also known without them ("Nasr City" as "Nasr")
+GENERIC_TERMS = {'city', 'governorate', 'district', 'egypt'}
+# Words common in compound and building names, which can't stand for a place on their own, so
+# "Garden City" isn't known as just "Garden"
+COMMON_TERMS = set(tokenize('garden park view heights hills residence towers village lake palm'))
+
+# Seed rows of the locations table: governorate -> cities -> districts, in dropdown order
+HIERARCHY = [
+    ('Cairo', [
+        ('Cairo', ['Downtown Cairo', 'Zamalek', 'Garden City', 'Maadi', 'Heliopolis', 'Nasr City', 'Mokattam']),
+        ('New Cairo', ['Fifth Settlement', 'Katameya Heights', 'Rehab City']),
+        ('Madinaty', []),
+        ('Shorouk City', []),
+        ('New Administrative Capital', []),
+    ]),
+    ('Giza', [
+        ('Giza', ['Dokki', 'Mohandessin', 'Agouza', 'Haram']),
+        ('6th of October City', []),
+        ('Sheikh Zayed City', []),
+    ]),
+    ('Qalyubia', [('Obour City', [])]),
+    ('Alexandria', [('Alexandria', ['Smouha', 'Stanley', 'Sidi Gaber'])]),
+    ('Matrouh', [('North Coast', ['Marina', 'Sidi Abdel Rahman'])]),
+    ('Suez', [('Ain Sokhna', [])]),
+    ('Red Sea', [('Hurghada', []), ('El Gouna', [])]),
+    ('South Sinai', [('Sharm El Sheikh', []), ('Dahab', [])]),
+]
+
+# Other names a place goes by, beyond the spellings the text search already folds together
+ALIASES = {
+    'Downtown Cairo': ['Downtown', 'Wust El Balad'],
+    'Fifth Settlement': ['Tagamoa', 'El Tagamoa El Khames', '5th Settlement'],
+    'Katameya Heights': ['Katameya'],
+    'New Administrative Capital': ['New Capital', 'Administrative Capital'],
+    '6th of October City': ['October'],
+    'Sheikh Zayed City': ['Zayed'],
+    'Haram': ['Pyramids'],
+    'North Coast': ['Sahel'],
+    'Ain Sokhna': ['Sokhna'],
+    'Sharm El Sheikh': ['Sharm'],
+}
+
+Location = namedtuple('Location', 'id name level parent_id depth')
+
+
+def _keys(name):
+    """Term tuples a place name is known by: in full, and without generic words if that leaves
+    something distinctive"""
+    terms = tuple(tokenize(name))
+    short = tuple(term for term in terms if term not in GENERIC_TERMS)
+    if short != terms and not set(short) <= COMMON_TERMS:
+        return [terms, short]
+    return [terms]
+
+
+class LocationTree:
+    """Locations table rows (id, name, level, parent_id) as a tree, with the normalizer"""
+
+    def __init__(self, rows):
+        children = {}
+        for location_id, name, level, parent_id in rows:
+            children.setdefault(parent_id, []).append((location_id, name, level))
+        self._nodes = {}
+        self._order = []
+        self._subtrees = {}
+        self._keys = {}     # name terms -> location; a name shared by a place and its parent means the parent
+
+        def visit(location_id, name, level, parent_id, depth):
+            node = Location(location_id, name, level, parent_id, depth)
+            self._nodes[location_id] = node
+            self._order.append(node)
+            for key in [key for text in [name] + ALIASES.get(name, []) for key in _keys(text)]:
+                if key and (key not in self._keys or self._keys[key].depth > depth):
+                    self._keys[key] = node
+            subtree = [location_id]
+            for child in sorted(children.get(location_id, [])):
+                subtree.extend(visit(*child, location_id, depth + 1))
+            self._subtrees[location_id] = tuple(subtree)
+            return subtree
+
+        for root in sorted(children.get(None, [])):
+            visit(*root, None, 0)
+        self._longest_key = max((len(key) for key in self._keys), default=0)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def get(self, location_id):
+        return self._nodes.get(location_id)
+
+    def options(self):
+        """Every location in hierarchy order, each place followed by the places within it"""
+        return list(self._order)
+
+    def subtree(self, location_id):
+        """Ids of the location and every location within it; empty for an unknown id"""
+        return self._subtrees.get(location_id, ())
+
+    def normalize(self, text):
+        """Id of the most specific location a free-text location names, or None.
+
+        Each comma-separated part is matched on its whole name, or else on
+        the known names it contains ("Villa near Maadi Corniche"). Places
+        named by whole parts are taken first, then those found inside parts;
+        a place is only kept if it lies within, or contains, every place kept
+        so far, so "Stanley Park, New Cairo" stays in New Cairo.
+        """
+        whole, contained = [], []
+        for part in (text or '').split(','):
+            terms = tuple(tokenize(part))
+            short = tuple(term for term in terms if term not in GENERIC_TERMS)
+            node = self._keys.get(terms) or self._keys.get(short)
+            if node is not None:
+                whole.append(node)
+            else:
+                contained.extend(self._contained(terms))
+        kept = []
+        # Within each group, more specific places first
+        for node in sorted(whole, key=lambda node: -node.depth) + contained:
+            if all(self._related(node, other) for other in kept):
+                kept.append(node)
+        best = max(kept, key=lambda node: node.depth, default=None)
+        return best.id if best is not None else None
+
+    def _contained(self, terms):
+        """Places whose names occur inside terms, longest names first, then the most specific"""
+        found = []
+        for length in range(min(len(terms) - 1, self._longest_key), 0, -1):
+            nodes = [self._keys[terms[start:start + length]] for start in range(len(terms) - length + 1)
+                     if terms[start:start + length] in self._keys]
+            found.extend(sorted(nodes, key=lambda node: -node.depth))
+        return found
+
+    def _related(self, node, other):
+        """Whether one of the two locations lies within the other (or they are the same)"""
+        return node.id in self._subtrees[other.id] or other.id in self._subtrees[node.id]
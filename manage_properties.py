@@ -491,29 +491,13 @@ def add_sample_properties():
     ]
 
     added_count = 0
-    for prop_data in properties_data:
-        try:
-            # Create property using Property.create method
-            Property.create(
-                title=prop_data['title'],
-                description=prop_data['description'],
-                price=prop_data['price'],
-                property_type=prop_data['property_type'],
-                location=prop_data['location'],
-                area=prop_data['area'],
-                bedrooms=prop_data['bedrooms'],
-                bathrooms=prop_data['bathrooms'],
-                down_payment=prop_data['down_payment'],
-                monthly_installment=prop_data['monthly_installment'],
-                installment_years=prop_data['installment_years'],
-                image=prop_data['image']
-            )
-            added_count += 1
+    try:
+        # Insert all properties in one batched transaction
+        added_count = len(Property.create_many(properties_data))
+        for prop_data in properties_data:
             print(f"Added property: {prop_data['title']}")
-
-        except Exception as e:
-            print(f"Error adding property {prop_data['title']}: {e}")
-            continue
+    except Exception as e:
+        print(f"Error adding properties: {e}")
 
     print(f"Successfully added {added_count} new properties")
     return added_count > 0
@@ -663,36 +647,23 @@ def add_additional_properties():
         }
     ]
 
-    added_count = 0
+    new_properties = []
     for prop_data in properties_data:
-        try:
-            # Check if property already exists
-            existing_property = Property.get_by_title(prop_data['title'])
-            if existing_property:
-                print(f"Property '{prop_data['title']}' already exists, skipping...")
-                continue
+        # Check if property already exists
+        existing_property = Property.get_by_title(prop_data['title'])
+        if existing_property:
+            print(f"Property '{prop_data['title']}' already exists, skipping...")
+            continue
+        new_properties.append(prop_data)
 
-            # Create property using Property.create method
-            Property.create(
-                title=prop_data['title'],
-                description=prop_data['description'],
-                price=prop_data['price'],
-                property_type=prop_data['property_type'],
-                location=prop_data['location'],
-                area=prop_data['area'],
-                bedrooms=prop_data['bedrooms'],
-                bathrooms=prop_data['bathrooms'],
-                down_payment=prop_data['down_payment'],
-                monthly_installment=prop_data['monthly_installment'],
-                installment_years=prop_data['installment_years'],
-                image=prop_data['image']
-            )
-            added_count += 1
+    added_count = 0
+    try:
+        # Insert the new properties in one batched transaction
+        added_count = len(Property.create_many(new_properties))
+        for prop_data in new_properties:
             print(f"Added property: {prop_data['title']}")
-
-        except Exception as e:
-            print(f"Error adding property {prop_data['title']}: {e}")
-            continue
+    except Exception as e:
+        print(f"Error adding properties: {e}")
 
     print(f"Successfully added {added_count} new properties")
     return added_count > 0
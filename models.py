@@ -1,9 +1,149 @@
+import base64
+import binascii
+import json
+import threading
 from flask_login import UserMixin
 from datetime import datetime
+from math import ceil
 from werkzeug.security import generate_password_hash, check_password_hash
+from cache import CachedValue, IdFilter, LRUCache, create_cache_backend
+from config import Config
 from db_utils import DatabaseConnection
+from listing_index import ListingIndex, index_row
+from locations import LocationTree
+from search import TextIndex, text_row
+from similar import SimilarIndex, listing_row, np
 
-db_conn = DatabaseConnection()
+# Shared storage and invalidation broadcast for every cache below and in the app
+cache_backend = create_cache_backend()
+
+db_conn = DatabaseConnection(cache_backend=cache_backend)
+
+# Single-row lookups by primary key; rows are cached as tuples and each call builds a fresh
+# object, and update()/delete() on the model drop the entry in every worker
+def _object_cache(name):
+    return LRUCache(name, max_entries=Config.OBJECT_CACHE_MAX_ENTRIES, ttl=Config.OBJECT_CACHE_TTL,
+                    max_bytes=Config.OBJECT_CACHE_MAX_BYTES // 2, backend=cache_backend, shared=True)
+
+property_cache = _object_cache('property')
+user_cache = _object_cache('user')
+
+# Users behind logged-in sessions, keyed by (id, version). User.update()/delete() bump the
+# version, so the next request loads the user afresh instead of trusting an older entry.
+session_user_cache = LRUCache('session_user', max_entries=Config.OBJECT_CACHE_MAX_ENTRIES,
+                              ttl=Config.SESSION_USER_CACHE_TTL, backend=cache_backend)
+_user_versions = {}
+_user_versions_lock = threading.Lock()
+
+def _bump_user_version(user_id):
+    with _user_versions_lock:
+        _user_versions[user_id] = _user_versions.get(user_id, 0) + 1
+
+cache_backend.on('user_version', _bump_user_version)
+
+# Called as listener(action, properties) after listings are created, updated or deleted, so
+# derived data (caches, indexes) can follow; action is 'create', 'update' or 'delete'
+_property_listeners = []
+
+def on_property_change(listener):
+    _property_listeners.append(listener)
+    return listener
+
+def _property_changed(action, properties):
+    for listener in _property_listeners:
+        try:
+            listener(action, properties)
+        except Exception as e:
+            # The write itself has succeeded; a listener failing mustn't turn it into an error
+            print(f"Error in property change listener {listener.__name__}: {str(e)}")
+
+class Pagination:
+    """One page of results plus the navigation state the templates use"""
+    def __init__(self, items, page, per_page, total, total_is_approximate=False):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        # True when total is a lower bound from a capped count
+        self.total_is_approximate = total_is_approximate
+        self.pages = ceil(total / per_page)
+        # Opaque keyset cursors for the neighbouring pages, when known
+        self.next_cursor = None
+        self.prev_cursor = None
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def has_next(self):
+        return self.page < self.pages
+
+    @property
+    def prev_num(self):
+        return self.page - 1
+
+    @property
+    def next_num(self):
+        return self.page + 1
+
+    def iter_pages(self, left_edge=2, left_current=2, right_current=5, right_edge=2):
+        """Iterate over the page numbers in the pagination.
+
+        Only the edge and current-page windows are visited, so the cost
+        doesn't depend on how many pages there are.
+        """
+        windows = sorted([
+            (1, min(left_edge, self.pages)),
+            (max(1, self.page - left_current), min(self.pages, self.page + right_current - 1)),
+            (max(1, self.pages - right_edge + 1), self.pages),
+        ])
+        last = 0
+        for start, end in windows:
+            for num in range(max(start, last + 1), end + 1):
+                if last + 1 != num:
+                    yield None
+                yield num
+                last = num
+
+# Listing orders by name: (column, descending); id breaks ties in the same direction
+SORT_ORDERS = {
+    'newest': ('created_at', True),
+    'oldest': ('created_at', False),
+    'price-low': ('price', False),
+    'price-high': ('price', True),
+    'area': ('area', True),
+}
+
+def encode_cursor(item, direction, page, total, sort='newest'):
+    """Opaque token pointing just past `item` in (sort column, id) order"""
+    key = getattr(item, SORT_ORDERS[sort][0])
+    data = {
+        'sort': sort,
+        'key': key.isoformat() if isinstance(key, datetime) else key,
+        'id': item.id,
+        'direction': direction,
+        'page': page,
+        'total': total,
+    }
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_cursor(token):
+    """Parse a cursor from encode_cursor(); malformed tokens are treated as absent"""
+    if not token:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        if data['direction'] not in ('next', 'prev'):
+            return None
+        if SORT_ORDERS[data['sort']][0] == 'created_at':
+            data['key'] = datetime.fromisoformat(data['key'])
+        else:
+            data['key'] = float(data['key'])
+        data['id'], data['page'], data['total'] = int(data['id']), int(data['page']), int(data['total'])
+        return data
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        return None
 
 class User(UserMixin):
     def __init__(self, id=None, email=None, password_hash=None, first_name=None, last_name=None,
@@ -63,35 +203,46 @@ class User(UserMixin):
         INSERT INTO users (email, password_hash, first_name, last_name, phone, created_at, is_active, is_admin)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """
-        conn, cursor = db_conn.execute_non_query(query, (
+        user.id = db_conn.insert_returning_id(query, (
             user.email, user.password_hash, user.first_name, user.last_name, user.phone,
             user.created_at, user.is_active, user.is_admin
         ))
-
-        cursor.execute("SELECT SCOPE_IDENTITY()")
-        result = cursor.fetchone()
-        if result and result[0] is not None:
-            user.id = int(result[0])
-        else:
-            # Check if user was actually inserted
-            cursor.execute("SELECT id FROM users WHERE email = ?", (user.email,))
-            check_result = cursor.fetchone()
-            if check_result and check_result[0] is not None:
-                user.id = int(check_result[0])
-            else:
-                raise Exception("Failed to create user - no ID returned from database and user not found")
-        db_conn.close_connection(conn, cursor)
         return user
 
     @classmethod
     def get_by_id(cls, user_id):
+        row = user_cache.get_or_load(user_id, lambda: cls._fetch_row(user_id))
+        if row:
+            return cls(*row)
+        return None
+
+    @classmethod
+    def get_session_user(cls, user_id):
+        """User for a logged-in session, served from memory while its version is current"""
+        key = (user_id, cls.version(user_id))
+        row = session_user_cache.get_or_load(key, lambda: cls._fetch_row(user_id))
+        if row:
+            return cls(*row)
+        return None
+
+    @staticmethod
+    def version(user_id):
+        return _user_versions.get(user_id, 0)
+
+    @staticmethod
+    def bump_version(user_id):
+        """Invalidate every cached copy of a user after it changes"""
+        _bump_user_version(user_id)
+        cache_backend.broadcast('user_version', user_id)
+        user_cache.delete(user_id)
+
+    @staticmethod
+    def _fetch_row(user_id):
         query = "SELECT * FROM users WHERE id = ?"
         conn, cursor = db_conn.execute_query(query, (user_id,))
         row = cursor.fetchone()
         db_conn.close_connection(conn, cursor)
-        if row:
-            return cls(*row)
-        return None
+        return tuple(row) if row else None
 
     @classmethod
     def get_by_email(cls, email):
@@ -121,11 +272,13 @@ class User(UserMixin):
             self.is_active, self.is_admin, self.id
         ))
         db_conn.close_connection(conn, cursor)
+        User.bump_version(self.id)
 
     def delete(self):
         query = "DELETE FROM users WHERE id=?"
         conn, cursor = db_conn.execute_non_query(query, (self.id,))
         db_conn.close_connection(conn, cursor)
+        User.bump_version(self.id)
 
     def get_properties(self):
         return Property.get_by_user_id(self.id)
@@ -133,11 +286,53 @@ class User(UserMixin):
     def get_favorites(self):
         return Favorite.get_by_user_id(self.id)
 
+# The locations hierarchy (see locations.py): small and rarely changed, so kept whole in
+# every worker; listings are filed under it as they are written
+def _load_location_tree():
+    return LocationTree(db_conn.fetch_all("SELECT id, name, level, parent_id FROM locations"))
+
+location_tree = CachedValue('location_tree', _load_location_tree, ttl=Config.LOCATION_TREE_TTL,
+                            backend=cache_backend)
+
+class Location:
+    """Lookups on the locations hierarchy; they find nothing until its migration has run"""
+
+    @staticmethod
+    def _tree():
+        try:
+            return location_tree.get()
+        except Exception as e:
+            print(f"Error loading locations: {str(e)}")
+            return None
+
+    @classmethod
+    def get_by_id(cls, location_id):
+        tree = cls._tree()
+        return tree.get(location_id) if tree is not None else None
+
+    @classmethod
+    def get_all(cls):
+        """Every location in hierarchy order, each place followed by the places within it"""
+        tree = cls._tree()
+        return tree.options() if tree is not None else []
+
+    @classmethod
+    def normalize(cls, text):
+        """Id of the most specific location a free-text location names, or None"""
+        tree = cls._tree()
+        return tree.normalize(text) if tree is not None else None
+
+    @classmethod
+    def subtree(cls, location_id):
+        """Ids of the location and every location within it"""
+        tree = cls._tree()
+        return tree.subtree(location_id) if tree is not None else ()
+
 class Property:
     def __init__(self, id=None, title=None, description=None, price=None, property_type=None,
                  location=None, area=None, bedrooms=0, bathrooms=0, down_payment=None,
                  monthly_installment=None, installment_years=None, image=None, created_at=None,
-                 updated_at=None, status='available', user_id=None):
+                 updated_at=None, status='available', user_id=None, location_id=None):
         self.id = id
         self.title = title
         self.description = description
@@ -155,9 +350,13 @@ class Property:
         self.updated_at = updated_at or self.created_at
         self.status = status
         self.user_id = user_id
+        self.location_id = location_id
+        # Set by listing queries that are given the viewing user
+        self.is_favorited = False
 
-    def to_dict(self):
-        return {
+    def to_dict(self, fields=None):
+        """Public fields of the listing; `fields` keeps only those names, plus id"""
+        data = {
             'id': self.id,
             'title': self.title,
             'description': self.description,
@@ -172,8 +371,12 @@ class Property:
             'installment_years': self.installment_years,
             'image': self.image,
             'created_at': self.created_at.strftime('%Y-%m-%d'),
-            'status': self.status
+            'status': self.status,
+            'location_id': self.location_id
         }
+        if fields is not None:
+            data = {name: value for name, value in data.items() if name == 'id' or name in fields}
+        return data
 
     def __repr__(self):
         return f'<Property {self.title}>'
@@ -185,49 +388,99 @@ class Property:
         prop = cls(title=title, description=description, price=price, property_type=property_type,
                    location=location, area=area, bedrooms=bedrooms, bathrooms=bathrooms,
                    down_payment=down_payment, monthly_installment=monthly_installment,
-                   installment_years=installment_years, image=image, user_id=user_id)
+                   installment_years=installment_years, image=image, user_id=user_id,
+                   location_id=Location.normalize(location))
 
         query = """
         INSERT INTO properties (title, description, price, property_type, location, area, bedrooms,
                                bathrooms, down_payment, monthly_installment, installment_years, image,
-                               created_at, updated_at, status, user_id)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                               created_at, updated_at, status, user_id, location_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """
+        prop.id = db_conn.insert_returning_id(query, (
+            prop.title, prop.description, prop.price, prop.property_type, prop.location, prop.area,
+            prop.bedrooms, prop.bathrooms, prop.down_payment, prop.monthly_installment,
+            prop.installment_years, prop.image, prop.created_at, prop.updated_at, prop.status, prop.user_id,
+            prop.location_id
+        ))
+        _property_changed('create', [prop])
+        return prop
+
+    # Columns written by create() and create_many(), in insert order
+    INSERT_COLUMNS = ('title', 'description', 'price', 'property_type', 'location', 'area', 'bedrooms',
+                      'bathrooms', 'down_payment', 'monthly_installment', 'installment_years', 'image',
+                      'created_at', 'updated_at', 'status', 'user_id', 'location_id')
+
+    @classmethod
+    def create_many(cls, items, batch_size=500, return_ids=True):
+        """Bulk-insert properties from dicts of create() arguments, one transaction per batch"""
+        props = [cls(**data) for data in items]
+        for prop in props:
+            if prop.location_id is None:
+                prop.location_id = Location.normalize(prop.location)
+        ids = db_conn.bulk_insert(
+            'properties', cls.INSERT_COLUMNS,
+            ([getattr(prop, column) for column in cls.INSERT_COLUMNS] for prop in props),
+            batch_size=batch_size, return_ids=return_ids
+        )
+        for prop, prop_id in zip(props, ids):
+            prop.id = prop_id
+        _property_changed('create', props)
+        return props
+
+    @classmethod
+    def get_by_id(cls, prop_id):
+        if cls.known_missing(prop_id):
+            return None
+        generation = missing_property_cache.generation
+        row = property_cache.get_or_load(prop_id, lambda: cls._fetch_row(prop_id))
+        if row:
+            return cls(*row)
+        missing_property_cache.set(prop_id, True, generation=generation)
+        return None
+
+    @staticmethod
+    def known_missing(prop_id):
+        """True when no property has this id, answered without a query"""
         try:
-            db_conn.cursor.execute(query, (
-                prop.title, prop.description, prop.price, prop.property_type, prop.location, prop.area,
-                prop.bedrooms, prop.bathrooms, prop.down_payment, prop.monthly_installment,
-                prop.installment_years, prop.image, prop.created_at, prop.updated_at, prop.status, prop.user_id
-            ))
-
-            db_conn.cursor.execute("SELECT SCOPE_IDENTITY() AS id")
-            result = db_conn.cursor.fetchone()
-            if result and result[0] is not None:
-                prop.id = int(result[0])
-            else:
-                # Try @@IDENTITY as fallback
-                db_conn.cursor.execute("SELECT @@IDENTITY AS id")
-                result = db_conn.cursor.fetchone()
-                if result and result[0] is not None:
-                    prop.id = int(result[0])
-                else:
-                    raise Exception("Failed to create property - no ID returned from database")
-
-            db_conn.commit()
-            return prop
+            id_filter = property_id_filter.get()
         except Exception as e:
-            db_conn.rollback()
-            raise e
+            print(f"Error loading property id filter: {str(e)}")
+            id_filter = None
+        if id_filter is not None and not id_filter.might_exist(prop_id):
+            return True
+        return missing_property_cache.get(prop_id) is not None
 
     @classmethod
-    def get_by_id(cls, prop_id):
+    def get_many(cls, prop_ids):
+        """Properties for prop_ids in the same order, reading only the ones not already cached"""
+        rows = {}
+        missing = []
+        for prop_id in prop_ids:
+            row = property_cache.get(prop_id)
+            if row is None:
+                missing.append(prop_id)
+            else:
+                rows[prop_id] = row
+        if missing:
+            generation = property_cache.generation
+            placeholders = ', '.join('?' * len(missing))
+            query = f"SELECT * FROM properties WHERE id IN ({placeholders})"
+            conn, cursor = db_conn.execute_query(query, missing)
+            fetched = cursor.fetchall()
+            db_conn.close_connection(conn, cursor)
+            for row in fetched:
+                rows[row[0]] = tuple(row)
+                property_cache.set(row[0], tuple(row), generation=generation)
+        return [cls(*rows[prop_id]) for prop_id in prop_ids if prop_id in rows]
+
+    @staticmethod
+    def _fetch_row(prop_id):
         query = "SELECT * FROM properties WHERE id = ?"
         conn, cursor = db_conn.execute_query(query, (prop_id,))
         row = cursor.fetchone()
         db_conn.close_connection(conn, cursor)
-        if row:
-            return cls(*row)
-        return None
+        return tuple(row) if row else None
 
     @classmethod
     def get_all(cls):
@@ -240,218 +493,358 @@ class Property:
     @classmethod
     def get_by_user_id(cls, user_id):
         query = "SELECT * FROM properties WHERE user_id = ? ORDER BY created_at DESC"
-        conn, cursor = db_conn.execute_query(query, (user_id,))
+        conn, cursor = db_conn.execute_query(query, (user_id,), cache_ttl=Config.QUERY_CACHE_TTL)
         rows = cursor.fetchall()
         db_conn.close_connection(conn, cursor)
         return [cls(*row) for row in rows]
 
+    @staticmethod
+    def _favorite_flag(user_id):
+        """Select column, join and params that flag the listings user_id has favorited"""
+        if user_id is None:
+            return "", "", []
+        # The unique (user_id, property_id) index keeps this to at most one match per listing
+        return (", CASE WHEN fav.property_id IS NULL THEN 0 ELSE 1 END AS is_favorited",
+                "LEFT JOIN (SELECT property_id FROM favorites WHERE user_id = ?) fav "
+                "ON fav.property_id = properties.id",
+                [user_id])
+
+    @classmethod
+    def _from_rows(cls, rows, user_id=None):
+        """Build properties from rows, reading the trailing is_favorited column when flagged"""
+        if user_id is None:
+            return [cls(*row) for row in rows]
+        items = []
+        for row in rows:
+            item = cls(*row[:-1])
+            item.is_favorited = bool(row[-1])
+            items.append(item)
+        return items
+
+    # The featured cache holds this many listings; smaller limits are served as slices of it
+    FEATURED_CACHE_SIZE = 12
+
     @classmethod
-    def get_featured(cls, limit=6):
+    def get_featured(cls, limit=6, user_id=None):
+        if limit <= cls.FEATURED_CACHE_SIZE:
+            rows = featured_cache.get()[:limit]
+        else:
+            rows = cls._fetch_featured(limit)
+        items = [cls(*row) for row in rows]
+        if user_id is not None:
+            favorited = Favorite.get_favorited_ids(user_id, [item.id for item in items])
+            for item in items:
+                item.is_favorited = item.id in favorited
+        return items
+
+    @staticmethod
+    def _fetch_featured(limit):
         query = "SELECT TOP (?) * FROM properties WHERE status = 'available' ORDER BY created_at DESC"
         conn, cursor = db_conn.execute_query(query, (limit,))
         rows = cursor.fetchall()
         db_conn.close_connection(conn, cursor)
-        return [cls(*row) for row in rows]
+        return [tuple(row) for row in rows]
 
     @classmethod
-    def get_available(cls, property_type='', location='', page=1, per_page=5):
-        from math import ceil
+    def get_available(cls, property_type='', location='', page=1, per_page=5, cursor=None,
+                      approximate_count=False, user_id=None, sort='newest', q='', **filters):
+        """Page of available listings; filters are those of _available_filter(), q is a full-text
+        query and sort is a SORT_ORDERS name, or 'relevance' to rank by q"""
+        filters = cls._location_filters(filters)
+        index = cls._listing_index()
+        text = cls._text_index() if q else None
+        # LIKE wildcards in the location only mean something to SQL
+        if index is not None and (text is not None or not q) and not any(char in location for char in '%_['):
+            try:
+                within = text.search(q) if text is not None else None
+                return cls._paginate_index(index, property_type, location, filters, page, per_page, cursor,
+                                           user_id, sort, within)
+            except Exception as e:
+                print(f"Error querying listing index: {str(e)}")
+        where, params = cls._available_filter(property_type, location, q=q, **filters)
+        return cls._paginate(where, params, page, per_page, cursor, approximate_count, user_id, sort)
+
+    @staticmethod
+    def _location_filters(filters):
+        """filters with a location_id swapped for the ids of that location and the places within it"""
+        location_id = filters.pop('location_id', None)
+        if location_id is not None:
+            filters['location_ids'] = Location.subtree(location_id)
+        return filters
+
+    @staticmethod
+    def _listing_index():
+        """The listing index once it has loaded; until then None, and the load is started"""
+        if listing_index is None:
+            return None
+        index = listing_index.peek()
+        if index is None:
+            warm_listing_index()
+        return index
+
+    @staticmethod
+    def _text_index():
+        """The full-text index once it has loaded; until then None, and the load is started"""
+        if text_index is None:
+            return None
+        index = text_index.peek()
+        if index is None:
+            warm_text_index()
+        return index
+
+    @classmethod
+    def _paginate_index(cls, index, property_type, location, filters, page, per_page, token, user_id, sort,
+                        within=None):
+        """get_available() answered from the listing index; same pages and cursors as _paginate().
+
+        `within` is the result of a text search; it limits the listings to its
+        matches, and sort='relevance' ranks them best first, a page at a time
+        without cursors.
+        """
+        if sort == 'relevance' and within is not None:
+            ids, total = index.search(property_type, location, column=None, offset=(page - 1) * per_page,
+                                      limit=per_page, within=within, **filters)
+            return Pagination(cls._listing_page(ids, user_id), page, per_page, total)
+
+        if sort not in SORT_ORDERS:
+            sort = 'newest'
+        column, descending = SORT_ORDERS[sort]
+        position = decode_cursor(token)
+        if position and position['sort'] == sort:
+            page, total = position['page'], position['total']
+            after = (position['direction'] == 'next', position['key'], position['id'])
+            ids, _ = index.search(property_type, location, column=column, descending=descending,
+                                  limit=per_page, after=after, within=within, **filters)
+        else:
+            ids, total = index.search(property_type, location, column=column, descending=descending,
+                                      offset=(page - 1) * per_page, limit=per_page, within=within, **filters)
+        return cls._with_cursors(Pagination(cls._listing_page(ids, user_id), page, per_page, total), sort)
 
-        # Build query with filters
-        query = "SELECT * FROM properties WHERE status = 'available'"
+    @classmethod
+    def _listing_page(cls, ids, user_id):
+        """Properties for a page of ids from the listing index, in that order"""
+
+        items = cls.get_many(ids)
+        if user_id is not None:
+            favorited = Favorite.get_favorited_ids(user_id, ids)
+            for item in items:
+                item.is_favorited = item.id in favorited
+        return items
+
+    @staticmethod
+    def _with_cursors(pagination, sort):
+        """Fill in the keyset cursors for the pages either side of this one"""
+        if pagination.items:
+            first, last = pagination.items[0], pagination.items[-1]
+            if pagination.has_next:
+                pagination.next_cursor = encode_cursor(last, 'next', pagination.page + 1, pagination.total, sort)
+            if pagination.has_prev:
+                pagination.prev_cursor = encode_cursor(first, 'prev', pagination.page - 1, pagination.total, sort)
+        return pagination
+
+    @staticmethod
+    def _available_filter(property_type='', location='', min_price=None, max_price=None,
+                          min_area=None, max_area=None, bedrooms=None, bathrooms=None, q='',
+                          location_ids=None):
+        """WHERE clause and params for the available listings matching the filters.
+
+        Prices and areas are inclusive ranges; bedrooms and bathrooms are minimums.
+        location_ids are those of a place and everything within it (see _location_filters()).
+        Without the text index, each word of q has to appear in the title,
+        description or location as typed.
+        """
+        where = "status = 'available'"
         params = []
 
         if property_type:
-            query += " AND property_type = ?"
+            where += " AND property_type = ?"
             params.append(property_type)
 
         if location:
-            query += " AND location LIKE ?"
+            where += " AND location LIKE ?"
             params.append(f'%{location}%')
 
-        query += " ORDER BY created_at DESC"
+        if location_ids is not None:
+            if location_ids:
+                where += f" AND location_id IN ({', '.join('?' * len(location_ids))})"
+                params.extend(location_ids)
+            else:
+                where += " AND 1 = 0"
 
-        # Get total count for pagination
-        count_query = f"SELECT COUNT(*) FROM properties WHERE status = 'available'"
-        count_params = []
-        if property_type:
-            count_query += " AND property_type = ?"
-            count_params.append(property_type)
-        if location:
-            count_query += " AND location LIKE ?"
-            count_params.append(f'%{location}%')
+        for column, operator, value in (('price', '>=', min_price), ('price', '<=', max_price),
+                                        ('area', '>=', min_area), ('area', '<=', max_area),
+                                        ('bedrooms', '>=', bedrooms), ('bathrooms', '>=', bathrooms)):
+            if value is not None:
+                where += f" AND {column} {operator} ?"
+                params.append(value)
 
-        conn, cursor = db_conn.execute_query(count_query, count_params)
-        total_count = cursor.fetchone()[0]
-        db_conn.close_connection(conn, cursor)
+        for word in (q or '').split():
+            where += " AND (title LIKE ? OR description LIKE ? OR location LIKE ?)"
+            params.extend([f'%{word}%'] * 3)
 
-        # Add pagination
-        offset = (page - 1) * per_page
-        query += " OFFSET ? ROWS FETCH NEXT ? ROWS ONLY"
-        params.extend([offset, per_page])
+        return where, params
 
-        conn, cursor = db_conn.execute_query(query, params)
-        rows = cursor.fetchall()
-        db_conn.close_connection(conn, cursor)
+    @classmethod
+    def get_available_version(cls, property_type='', location='', **filters):
+        """(latest updated_at, row count) of the available listings matching the filters.
 
-        # Create pagination object
-        class Pagination:
-            def __init__(self, items, page, per_page, total):
-                self.items = items
-                self.page = page
-                self.per_page = per_page
-                self.total = total
-                self.pages = ceil(total / per_page)
-
-            def has_prev(self):
-                return self.page > 1
-
-            def has_next(self):
-                return self.page < self.pages
-
-            def prev_num(self):
-                return self.page - 1
-
-            def next_num(self):
-                return self.page + 1
-
-            def iter_pages(self, left_edge=2, left_current=2, right_current=5, right_edge=2):
-                """Iterate over the page numbers in the pagination."""
-                last = 0
-                for num in range(1, self.pages + 1):
-                    if num <= left_edge or \
-                       (num > self.page - left_current - 1 and \
-                        num < self.page + right_current) or \
-                       num > self.pages - right_edge:
-                        if last + 1 != num:
-                            yield None
-                        yield num
-                        last = num
-
-        return Pagination([cls(*row) for row in rows], page, per_page, total_count)
-
-    @classmethod
-    def get_all_paginated(cls, page=1, per_page=10):
-        from math import ceil
-
-        # Get total count
-        count_query = "SELECT COUNT(*) FROM properties"
-        conn, cursor = db_conn.execute_query(count_query)
-        total_count = cursor.fetchone()[0]
-        db_conn.close_connection(conn, cursor)
+        Cheap enough to check before rendering a listing page; the count
+        changes on deletes, which don't move the latest updated_at.
+        """
+        where, params = cls._available_filter(property_type, location, **cls._location_filters(filters))
+        row = db_conn.fetch_one(f"SELECT MAX(updated_at), COUNT(*) FROM properties WHERE {where}", params)
+        last_modified, count = row
+        # SQLite can't see the column type through MAX(), so it hands back the stored text
+        if isinstance(last_modified, str):
+            last_modified = datetime.fromisoformat(last_modified)
+        return last_modified, count
 
-        # Get paginated results
-        offset = (page - 1) * per_page
-        query = "SELECT * FROM properties ORDER BY created_at DESC OFFSET ? ROWS FETCH NEXT ? ROWS ONLY"
-        conn, cursor = db_conn.execute_query(query, (offset, per_page))
-        rows = cursor.fetchall()
-        db_conn.close_connection(conn, cursor)
+    @classmethod
+    def get_all_paginated(cls, page=1, per_page=10, cursor=None):
+        return cls._paginate("1 = 1", [], page, per_page, cursor)
 
-        # Create pagination object
-        class Pagination:
-            def __init__(self, items, page, per_page, total):
-                self.items = items
-                self.page = page
-                self.per_page = per_page
-                self.total = total
-                self.pages = ceil(total / per_page)
-
-            def has_prev(self):
-                return self.page > 1
-
-            def has_next(self):
-                return self.page < self.pages
-
-            def prev_num(self):
-                return self.page - 1
-
-            def next_num(self):
-                return self.page + 1
-
-            def iter_pages(self, left_edge=2, left_current=2, right_current=5, right_edge=2):
-                """Iterate over the page numbers in the pagination."""
-                last = 0
-                for num in range(1, self.pages + 1):
-                    if num <= left_edge or \
-                       (num > self.page - left_current - 1 and \
-                        num < self.page + right_current) or \
-                       num > self.pages - right_edge:
-                        if last + 1 != num:
-                            yield None
-                        yield num
-                        last = num
-
-        return Pagination([cls(*row) for row in rows], page, per_page, total_count)
-
-    @classmethod
-    def get_by_user_paginated(cls, user_id, page=1, per_page=10):
-        from math import ceil
-
-        # Get total count for user
-        count_query = "SELECT COUNT(*) FROM properties WHERE user_id = ?"
-        conn, cursor = db_conn.execute_query(count_query, (user_id,))
-        total_count = cursor.fetchone()[0]
-        db_conn.close_connection(conn, cursor)
+    @classmethod
+    def get_by_user_paginated(cls, user_id, page=1, per_page=10, cursor=None):
+        return cls._paginate("user_id = ?", [user_id], page, per_page, cursor)
+
+    @classmethod
+    def get_favorites_for_user(cls, user_id, page=1, per_page=9):
+        """A user's favorited properties, most recently favorited first.
 
-        # Get paginated results for user
+        Favorites are joined to their listings in one statement that also
+        carries the total; favorites of deleted listings drop out of the join.
+        """
         offset = (page - 1) * per_page
-        query = "SELECT * FROM properties WHERE user_id = ? ORDER BY created_at DESC OFFSET ? ROWS FETCH NEXT ? ROWS ONLY"
-        conn, cursor = db_conn.execute_query(query, (user_id, offset, per_page))
+        favorites = "favorites f INNER JOIN properties p ON p.id = f.property_id WHERE f.user_id = ?"
+        query = (f"SELECT p.*, (SELECT COUNT(*) FROM {favorites}) AS total_count FROM {favorites} "
+                 "ORDER BY f.created_at DESC, f.id DESC OFFSET ? ROWS FETCH NEXT ? ROWS ONLY")
+        conn, cursor = db_conn.execute_query(query, (user_id, user_id, offset, per_page))
         rows = cursor.fetchall()
         db_conn.close_connection(conn, cursor)
 
-        # Create pagination object
-        class Pagination:
-            def __init__(self, items, page, per_page, total):
-                self.items = items
-                self.page = page
-                self.per_page = per_page
-                self.total = total
-                self.pages = ceil(total / per_page)
-
-            def has_prev(self):
-                return self.page > 1
-
-            def has_next(self):
-                return self.page < self.pages
+        if rows:
+            total = rows[0][-1]
+        else:
+            conn, cursor = db_conn.execute_query(f"SELECT COUNT(*) FROM {favorites}", (user_id,))
+            total = cursor.fetchone()[0]
+            db_conn.close_connection(conn, cursor)
+        return Pagination([cls(*row[:-1]) for row in rows], page, per_page, total)
 
-            def prev_num(self):
-                return self.page - 1
+    # With approximate counts, count at most this many pages beyond the current one
+    APPROXIMATE_COUNT_PAGES = 10
 
-            def next_num(self):
-                return self.page + 1
+    @classmethod
+    def _paginate(cls, where, params, page, per_page, token=None, approximate_count=False,
+                  user_id=None, sort='newest'):
+        """Page of properties matching `where` in a SORT_ORDERS order, newest first by default.
+
+        With a cursor from a previous page in the same order the query seeks
+        past that page's boundary row on (sort column, id), so its cost doesn't
+        grow with the page number; the total is carried in the cursor instead
+        of recounted.
+        Otherwise the page and its total come back from one statement. With
+        approximate_count the total is capped a few pages past this one, so
+        huge filtered sets aren't counted in full. Given a user_id, each
+        property's is_favorited is filled in from the same statement.
+        """
+        approximate = False
+        if sort not in SORT_ORDERS:
+            sort = 'newest'
+        column, descending = SORT_ORDERS[sort]
+        flag, join, join_params = cls._favorite_flag(user_id)
+        position = decode_cursor(token)
+        if position and position['sort'] == sort:
+            page, total = position['page'], position['total']
+            boundary = position['key']
+            # Going forward in a descending order means smaller keys, and so on
+            toward, order = ('<', 'DESC') if descending == (position['direction'] == 'next') else ('>', 'ASC')
+            # The leading bound on the sort column alone is what lets the index range-seek
+            seek = f"{column} {toward}= ? AND ({column} {toward} ? OR id {toward} ?)"
+            query = (f"SELECT TOP (?) properties.*{flag} FROM properties {join} "
+                     f"WHERE {where} AND {seek} ORDER BY {column} {order}, id {order}")
+            conn, cursor = db_conn.execute_query(
+                query, [per_page, *join_params, *params, boundary, boundary, position['id']])
+            rows = cursor.fetchall()
+            db_conn.close_connection(conn, cursor)
+            if position['direction'] == 'prev':
+                rows.reverse()
+        else:
+            offset = (page - 1) * per_page
+            if approximate_count:
+                cap = (page + cls.APPROXIMATE_COUNT_PAGES) * per_page
+                total_column = f"(SELECT COUNT(*) FROM (SELECT TOP (?) id FROM properties WHERE {where}) AS capped)"
+                total_params = [cap, *params]
+            else:
+                # An uncorrelated subquery is counted once off the index; COUNT(*) OVER ()
+                # would drag every matching row through the window operator instead
+                total_column = f"(SELECT COUNT(*) FROM properties WHERE {where})"
+                total_params = list(params)
+            order = 'DESC' if descending else 'ASC'
+            query = (f"SELECT properties.*{flag}, {total_column} AS total_count FROM properties {join} "
+                     f"WHERE {where} ORDER BY {column} {order}, id {order} OFFSET ? ROWS FETCH NEXT ? ROWS ONLY")
+            conn, cursor = db_conn.execute_query(
+                query, [*total_params, *join_params, *params, offset, per_page])
+            rows = cursor.fetchall()
+            db_conn.close_connection(conn, cursor)
+
+            if rows:
+                total = rows[0][-1]
+                rows = [row[:-1] for row in rows]
+            else:
+                # Past the last page there is no row to carry the total
+                conn, cursor = db_conn.execute_query(f"SELECT {total_column}", total_params)
+                total = cursor.fetchone()[0]
+                db_conn.close_connection(conn, cursor)
+            approximate = approximate_count and total >= cap
 
-            def iter_pages(self, left_edge=2, left_current=2, right_current=5, right_edge=2):
-                """Iterate over the page numbers in the pagination."""
-                last = 0
-                for num in range(1, self.pages + 1):
-                    if num <= left_edge or \
-                       (num > self.page - left_current - 1 and \
-                        num < self.page + right_current) or \
-                       num > self.pages - right_edge:
-                        if last + 1 != num:
-                            yield None
-                        yield num
-                        last = num
+        pagination = Pagination(cls._from_rows(rows, user_id), page, per_page, total, approximate)
+        return cls._with_cursors(pagination, sort)
 
-        return Pagination([cls(*row) for row in rows], page, per_page, total_count)
+    @classmethod
+    def get_similar(cls, property_id, property_type, limit=3, user_id=None):
+        """Available listings most like property_id, from the similar-listings index when it's
+        available and otherwise the newest of the same type"""
+        prop = cls.get_by_id(property_id)
+        index = cls._similar_index() if prop is not None else None
+        if index is None:
+            return cls._newest_of_type(property_id, property_type, limit, user_id)
+
+        items = [item for item in cls.get_many(index.similar(listing_row(prop), limit))
+                 if item.status == 'available']
+        if user_id is not None:
+            favorited = Favorite.get_favorited_ids(user_id, [item.id for item in items])
+            for item in items:
+                item.is_favorited = item.id in favorited
+        return items
+
+    @staticmethod
+    def _similar_index():
+        if similar_index is None:
+            return None
+        try:
+            return similar_index.get()
+        except Exception as e:
+            print(f"Error loading similar-listings index: {str(e)}")
+            return None
 
     @classmethod
-    def get_similar(cls, property_id, property_type, limit=3):
-        query = """
-        SELECT TOP (?) * FROM properties
+    def _newest_of_type(cls, property_id, property_type, limit, user_id):
+        flag, join, join_params = cls._favorite_flag(user_id)
+        query = f"""
+        SELECT TOP (?) properties.*{flag} FROM properties {join}
         WHERE property_type = ? AND id != ? AND status = 'available'
         ORDER BY created_at DESC
         """
-        conn, cursor = db_conn.execute_query(query, (limit, property_type, property_id))
+        conn, cursor = db_conn.execute_query(query, (limit, *join_params, property_type, property_id),
+                                             cache_ttl=Config.QUERY_CACHE_TTL)
         rows = cursor.fetchall()
         db_conn.close_connection(conn, cursor)
-        return [cls(*row) for row in rows]
+        return cls._from_rows(rows, user_id)
 
     @classmethod
     def get_by_status(cls, status):
         query = "SELECT * FROM properties WHERE status = ? ORDER BY created_at DESC"
-        conn, cursor = db_conn.execute_query(query, (status,))
+        conn, cursor = db_conn.execute_query(query, (status,), cache_ttl=Config.QUERY_CACHE_TTL)
         rows = cursor.fetchall()
         db_conn.close_connection(conn, cursor)
         return [cls(*row) for row in rows]
@@ -468,29 +861,212 @@ class Property:
 
     def update(self):
         self.updated_at = datetime.utcnow()
+        self.location_id = Location.normalize(self.location)
         query = """
         UPDATE properties SET title=?, description=?, price=?, property_type=?, location=?, area=?,
                              bedrooms=?, bathrooms=?, down_payment=?, monthly_installment=?,
-                             installment_years=?, image=?, updated_at=?, status=?, user_id=?
+                             installment_years=?, image=?, updated_at=?, status=?, user_id=?, location_id=?
         WHERE id=?
         """
         conn, cursor = db_conn.execute_non_query(query, (
             self.title, self.description, self.price, self.property_type, self.location, self.area,
             self.bedrooms, self.bathrooms, self.down_payment, self.monthly_installment,
-            self.installment_years, self.image, self.updated_at, self.status, self.user_id, self.id
+            self.installment_years, self.image, self.updated_at, self.status, self.user_id,
+            self.location_id, self.id
         ))
         db_conn.close_connection(conn, cursor)
+        property_cache.delete(self.id)
+        _property_changed('update', [self])
 
     def delete(self):
         query = "DELETE FROM properties WHERE id=?"
         conn, cursor = db_conn.execute_non_query(query, (self.id,))
         db_conn.close_connection(conn, cursor)
+        property_cache.delete(self.id)
+        _property_changed('delete', [self])
 
     def get_owner(self):
         if self.user_id:
             return User.get_by_id(self.user_id)
         return None
 
+# Newest available listings for the homepage, recomputed by the write that changes them
+featured_cache = CachedValue('featured', lambda: Property._fetch_featured(Property.FEATURED_CACHE_SIZE),
+                             ttl=Config.FEATURED_CACHE_TTL, backend=cache_backend)
+
+@on_property_change
+def _refresh_featured(action, properties):
+    featured_cache.refresh()
+
+# Nearest neighbours for get_similar, built on first use; every worker sharing the cache backend
+# applies each listing write to its copy, and the TTL rebuild picks up the rest (Config.INDEX_TTL)
+def _load_similar_index():
+    query = """
+    SELECT id, property_type, location, price, area, bedrooms, bathrooms, status
+    FROM properties WHERE status = 'available'
+    """
+    conn, cursor = db_conn.execute_query(query)
+    rows = [tuple(row) for row in cursor.fetchall()]
+    db_conn.close_connection(conn, cursor)
+    return SimilarIndex(rows)
+
+similar_index = (CachedValue('similar_index', _load_similar_index, ttl=Config.SIMILAR_INDEX_TTL,
+                             backend=cache_backend)
+                 if np is not None and Config.SIMILAR_INDEX_ENABLED else None)
+
+def _update_similar_index(action, rows):
+    if similar_index is None:
+        return
+    index = similar_index.peek()
+    if index is None:
+        # A load under way may have read the table before this write; don't keep what it read
+        similar_index._invalidate_local()
+        return
+    if action == 'delete':
+        index.remove([row[0] for row in rows])
+    else:
+        index.upsert(rows)
+
+cache_backend.on('similar_index', _update_similar_index)
+
+@on_property_change
+def _track_similar_listings(action, properties):
+    if similar_index is None:
+        return
+    rows = [listing_row(prop) for prop in properties if prop.id is not None]
+    _update_similar_index(action, rows)
+    cache_backend.broadcast('similar_index', action, rows)
+
+# Columns of every available listing for get_available, loaded in the background at startup
+# (SQL answers until it's ready) and kept current like the similar index
+def _load_listing_index():
+    query = """
+    SELECT id, property_type, location, price, area, bedrooms, bathrooms, status, created_at, location_id
+    FROM properties WHERE status = 'available'
+    """
+    conn, cursor = db_conn.execute_query(query)
+    rows = [tuple(row) for row in cursor.fetchall()]
+    db_conn.close_connection(conn, cursor)
+    return ListingIndex(rows)
+
+listing_index = (CachedValue('listing_index', _load_listing_index, ttl=Config.LISTING_INDEX_TTL,
+                             backend=cache_backend)
+                 if np is not None and Config.LISTING_INDEX_ENABLED else None)
+
+def _background_loader(cached, name):
+    """A function that starts loading `cached` in a background thread, unless a load is running"""
+    loading = threading.Lock()
+
+    def warm():
+        if cached is None or not loading.acquire(blocking=False):
+            return
+
+        def load():
+            try:
+                cached.get()
+            except Exception as e:
+                print(f"Error loading {name}: {str(e)}")
+            finally:
+                loading.release()
+
+        threading.Thread(target=load, name=f"{name.replace(' ', '-')}-loader", daemon=True).start()
+
+    return warm
+
+warm_listing_index = _background_loader(listing_index, 'listing index')
+
+def _update_listing_index(action, rows):
+    if listing_index is None:
+        return
+    index = listing_index.peek()
+    if index is None:
+        listing_index._invalidate_local()
+        return
+    if action == 'delete':
+        index.remove([row[0] for row in rows])
+    else:
+        index.upsert(rows)
+
+cache_backend.on('listing_index', _update_listing_index)
+
+@on_property_change
+def _track_listing_index(action, properties):
+    if listing_index is None:
+        return
+    rows = [index_row(prop) for prop in properties if prop.id is not None]
+    _update_listing_index(action, rows)
+    cache_backend.broadcast('listing_index', action, rows)
+
+# Inverted index of listing text for get_available(q=...), loaded and kept current like the
+# listing index; the TTL rebuild drops the entries that updates leave behind
+def _load_text_index():
+    query = "SELECT id, title, description, location, status FROM properties WHERE status = 'available'"
+    conn, cursor = db_conn.execute_query(query)
+    rows = [tuple(row) for row in cursor.fetchall()]
+    db_conn.close_connection(conn, cursor)
+    return TextIndex(rows)
+
+text_index = (CachedValue('text_index', _load_text_index, ttl=Config.TEXT_INDEX_TTL, backend=cache_backend)
+              if np is not None and Config.TEXT_INDEX_ENABLED else None)
+warm_text_index = _background_loader(text_index, 'text index')
+
+def _update_text_index(action, rows):
+    if text_index is None:
+        return
+    index = text_index.peek()
+    if index is None:
+        text_index._invalidate_local()
+        return
+    if action == 'delete':
+        index.remove([row[0] for row in rows])
+    else:
+        index.upsert(rows)
+
+cache_backend.on('text_index', _update_text_index)
+
+@on_property_change
+def _track_text_index(action, properties):
+    if text_index is None:
+        return
+    rows = [text_row(prop) for prop in properties if prop.id is not None]
+    _update_text_index(action, rows)
+    cache_backend.broadcast('text_index', action, rows)
+
+# Ids that don't exist, for get_by_id to answer without a query: the filter knows every id up
+# to the highest one it saw when built, and the LRU remembers misses beyond that
+def _load_property_ids():
+    query = "SELECT id FROM properties WHERE id <= ?"
+    conn, cursor = db_conn.execute_query(query, (Config.PROPERTY_ID_FILTER_MAX_ID,))
+    ids = [row[0] for row in cursor.fetchall()]
+    db_conn.close_connection(conn, cursor)
+    return IdFilter(ids, max(ids, default=0))
+
+property_id_filter = CachedValue('property_ids', _load_property_ids, ttl=Config.PROPERTY_ID_FILTER_TTL,
+                                 backend=cache_backend)
+missing_property_cache = LRUCache('missing_property', max_entries=Config.MISSING_PROPERTY_CACHE_MAX_ENTRIES,
+                                  ttl=Config.MISSING_PROPERTY_CACHE_TTL, backend=cache_backend)
+
+def _update_property_ids(action, *ids):
+    id_filter = property_id_filter.peek()
+    if id_filter is None:
+        return
+    if action == 'create':
+        id_filter.add(*ids)
+    else:
+        id_filter.discard(*ids)
+
+cache_backend.on('property_ids', _update_property_ids)
+
+@on_property_change
+def _track_property_ids(action, properties):
+    if action == 'update':
+        return
+    ids = [prop.id for prop in properties if prop.id is not None]
+    _update_property_ids(action, *ids)
+    cache_backend.broadcast('property_ids', action, *ids)
+    if action == 'create':
+        missing_property_cache.clear()
+
 class Favorite:
     def __init__(self, id=None, user_id=None, property_id=None, created_at=None):
         self.id = id
@@ -506,27 +1082,8 @@ class Favorite:
         fav = cls(user_id=user_id, property_id=property_id)
 
         query = "INSERT INTO favorites (user_id, property_id, created_at) VALUES (?, ?, ?)"
-        try:
-            db_conn.cursor.execute(query, (fav.user_id, fav.property_id, fav.created_at))
-
-            db_conn.cursor.execute("SELECT SCOPE_IDENTITY() AS id")
-            result = db_conn.cursor.fetchone()
-            if result and result[0] is not None:
-                fav.id = int(result[0])
-            else:
-                # Try @@IDENTITY as fallback
-                db_conn.cursor.execute("SELECT @@IDENTITY AS id")
-                result = db_conn.cursor.fetchone()
-                if result and result[0] is not None:
-                    fav.id = int(result[0])
-                else:
-                    raise Exception("Failed to create favorite - no ID returned from database")
-
-            db_conn.commit()
-            return fav
-        except Exception as e:
-            db_conn.rollback()
-            raise e
+        fav.id = db_conn.insert_returning_id(query, (fav.user_id, fav.property_id, fav.created_at))
+        return fav
 
     @classmethod
     def get_by_id(cls, fav_id):
@@ -562,6 +1119,19 @@ class Favorite:
         db_conn.close_connection(conn, cursor)
         return [cls(*row) for row in rows]
 
+    @classmethod
+    def get_favorited_ids(cls, user_id, property_ids):
+        """The subset of property_ids that user_id has favorited"""
+        property_ids = list(property_ids)
+        if not property_ids:
+            return set()
+        placeholders = ', '.join('?' * len(property_ids))
+        query = f"SELECT property_id FROM favorites WHERE user_id = ? AND property_id IN ({placeholders})"
+        conn, cursor = db_conn.execute_query(query, (user_id, *property_ids))
+        rows = cursor.fetchall()
+        db_conn.close_connection(conn, cursor)
+        return {row[0] for row in rows}
+
     @classmethod
     def get_by_user_and_property(cls, user_id, property_id):
         query = "SELECT * FROM favorites WHERE user_id = ? AND property_id = ?"
@@ -625,30 +1195,11 @@ class ContactMessage:
         INSERT INTO contact_messages (name, email, phone, subject, message, property_id, created_at, is_read)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """
-        try:
-            db_conn.cursor.execute(query, (
-                msg.name, msg.email, msg.phone, msg.subject, msg.message, msg.property_id,
-                msg.created_at, msg.is_read
-            ))
-
-            db_conn.cursor.execute("SELECT SCOPE_IDENTITY() AS id")
-            result = db_conn.cursor.fetchone()
-            if result and result[0] is not None:
-                msg.id = int(result[0])
-            else:
-                # Try @@IDENTITY as fallback
-                db_conn.cursor.execute("SELECT @@IDENTITY AS id")
-                result = db_conn.cursor.fetchone()
-                if result and result[0] is not None:
-                    msg.id = int(result[0])
-                else:
-                    raise Exception("Failed to create contact message - no ID returned from database")
-
-            db_conn.commit()
-            return msg
-        except Exception as e:
-            db_conn.rollback()
-            raise e
+        msg.id = db_conn.insert_returning_id(query, (
+            msg.name, msg.email, msg.phone, msg.subject, msg.message, msg.property_id,
+            msg.created_at, msg.is_read
+        ))
+        return msg
 
     @classmethod
     def get_by_id(cls, msg_id):
@@ -671,7 +1222,7 @@ class ContactMessage:
     @classmethod
     def get_by_property_id(cls, property_id):
         query = "SELECT * FROM contact_messages WHERE property_id = ? ORDER BY created_at DESC"
-        conn, cursor = db_conn.execute_query(query, (property_id,))
+        conn, cursor = db_conn.execute_query(query, (property_id,), cache_ttl=Config.QUERY_CACHE_TTL)
         rows = cursor.fetchall()
         db_conn.close_connection(conn, cursor)
         return [cls(*row) for row in rows]
@@ -725,29 +1276,10 @@ class ChatHistory:
         INSERT INTO chat_history (user_id, timestamp, role, message)
         VALUES (?, ?, ?, ?)
         """
-        try:
-            db_conn.cursor.execute(query, (
-                chat.user_id, chat.timestamp, chat.role, chat.message
-            ))
-
-            db_conn.cursor.execute("SELECT SCOPE_IDENTITY() AS id")
-            result = db_conn.cursor.fetchone()
-            if result and result[0] is not None:
-                chat.id = int(result[0])
-            else:
-                # Try @@IDENTITY as fallback
-                db_conn.cursor.execute("SELECT @@IDENTITY AS id")
-                result = db_conn.cursor.fetchone()
-                if result and result[0] is not None:
-                    chat.id = int(result[0])
-                else:
-                    raise Exception("Failed to create chat history - no ID returned from database")
-
-            db_conn.commit()
-            return chat
-        except Exception as e:
-            db_conn.rollback()
-            raise e
+        chat.id = db_conn.insert_returning_id(query, (
+            chat.user_id, chat.timestamp, chat.role, chat.message
+        ))
+        return chat
 
     @classmethod
     def get_by_user_id(cls, user_id, limit=50):
@@ -0,0 +1,208 @@
+"""Minimal Redis-protocol server for development and tests.
+
+Speaks enough of the protocol for RedisBackend: PING, ECHO, SELECT, GET, SET
+(with EX/PX/NX/XX), DEL, EXISTS, INCR, EXPIRE, TTL, FLUSHDB, PUBLISH,
+SUBSCRIBE and UNSUBSCRIBE. Data lives in memory and is lost on exit.
+
+    python resp_server.py [port]
+    CACHE_BACKEND=redis CACHE_REDIS_URL=redis://127.0.0.1:6379/0 python app.py
+"""
+import socketserver
+import sys
+import threading
+import time
+from cache import RespError, resp_encode, resp_read
+
+
+class RespServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, RespHandler)
+        self.lock = threading.Lock()
+        self.data = {}              # key -> (value, expires_at or None)
+        self.subscribers = {}       # channel -> set of handlers
+
+    def lookup(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def publish(self, channel, message):
+        with self.lock:
+            handlers = list(self.subscribers.get(channel, ()))
+        delivered = 0
+        for handler in handlers:
+            if handler.push([b'message', channel, message]):
+                delivered += 1
+        return delivered
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.channels = set()
+        self.write_lock = threading.Lock()
+
+    def push(self, value):
+        """Write a reply; False when the client has gone away"""
+        try:
+            with self.write_lock:
+                self.wfile.write(resp_encode(value))
+                self.wfile.flush()
+            return True
+        except OSError:
+            return False
+
+    def handle(self):
+        try:
+            while True:
+                command = resp_read(self.rfile)
+                if not isinstance(command, list) or not command:
+                    self.push(RespError("ERR protocol error"))
+                    return
+                name = command[0].decode().upper()
+                if name == 'QUIT':
+                    self.push('OK')
+                    return
+                handler = getattr(self, f'cmd_{name.lower()}', None)
+                if handler is None:
+                    self.push(RespError(f"ERR unknown command '{name}'"))
+                    continue
+                try:
+                    reply = handler(*command[1:])
+                except (TypeError, ValueError):
+                    reply = RespError(f"ERR wrong arguments for '{name}' command")
+                if reply is not NotImplemented:
+                    self.push(reply)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.unsubscribe_all()
+
+    def unsubscribe_all(self):
+        with self.server.lock:
+            for channel in self.channels:
+                self.server.subscribers.get(channel, set()).discard(self)
+        self.channels.clear()
+
+    def cmd_ping(self, message=None):
+        return message if message is not None else b'PONG'
+
+    def cmd_echo(self, message):
+        return message
+
+    def cmd_select(self, db):
+        int(db)
+        return b'OK'
+
+    def cmd_get(self, key):
+        with self.server.lock:
+            return self.server.lookup(key)
+
+    def cmd_set(self, key, value, *options):
+        expires_at = None
+        only_if_missing = only_if_present = False
+        options = [option.upper() if isinstance(option, bytes) else option for option in options]
+        i = 0
+        while i < len(options):
+            if options[i] in (b'EX', b'PX'):
+                amount = int(options[i + 1])
+                expires_at = time.monotonic() + (amount if options[i] == b'EX' else amount / 1000)
+                i += 2
+            elif options[i] == b'NX':
+                only_if_missing = True
+                i += 1
+            elif options[i] == b'XX':
+                only_if_present = True
+                i += 1
+            else:
+                return RespError("ERR syntax error")
+        with self.server.lock:
+            exists = self.server.lookup(key) is not None
+            if (only_if_missing and exists) or (only_if_present and not exists):
+                return None
+            self.server.data[key] = (value, expires_at)
+        return b'OK'
+
+    def cmd_del(self, *keys):
+        with self.server.lock:
+            removed = 0
+            for key in keys:
+                if self.server.lookup(key) is not None:
+                    del self.server.data[key]
+                    removed += 1
+        return removed
+
+    def cmd_exists(self, *keys):
+        with self.server.lock:
+            return sum(1 for key in keys if self.server.lookup(key) is not None)
+
+    def cmd_incr(self, key):
+        with self.server.lock:
+            value = int(self.server.lookup(key) or 0) + 1
+            expires_at = self.server.data.get(key, (None, None))[1]
+            self.server.data[key] = (str(value).encode(), expires_at)
+        return value
+
+    def cmd_expire(self, key, seconds):
+        with self.server.lock:
+            value = self.server.lookup(key)
+            if value is None:
+                return 0
+            self.server.data[key] = (value, time.monotonic() + int(seconds))
+        return 1
+
+    def cmd_ttl(self, key):
+        with self.server.lock:
+            if self.server.lookup(key) is None:
+                return -2
+            expires_at = self.server.data[key][1]
+        return -1 if expires_at is None else int(expires_at - time.monotonic())
+
+    def cmd_flushdb(self):
+        with self.server.lock:
+            self.server.data.clear()
+        return b'OK'
+
+    cmd_flushall = cmd_flushdb
+
+    def cmd_publish(self, channel, message):
+        return self.server.publish(channel, message)
+
+    def cmd_subscribe(self, *channels):
+        for channel in channels:
+            with self.server.lock:
+                self.server.subscribers.setdefault(channel, set()).add(self)
+            self.channels.add(channel)
+            self.push([b'subscribe', channel, len(self.channels)])
+        return NotImplemented
+
+    def cmd_unsubscribe(self, *channels):
+        for channel in channels or list(self.channels):
+            with self.server.lock:
+                self.server.subscribers.get(channel, set()).discard(self)
+            self.channels.discard(channel)
+            self.push([b'unsubscribe', channel, len(self.channels)])
+        return NotImplemented
+
+
+def serve(host='127.0.0.1', port=6379):
+    server = RespServer((host, port))
+    print(f"✅ Redis-protocol stand-in listening on {host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else 6379)
@@ -0,0 +1,260 @@
+"""Full-text search over listing titles, descriptions and locations.
+
+Text is folded to terms that are the same for English and for the usual
+Latin and Arabic spellings of Egyptian place names ("Sheikh Zayed",
+"El-Shaikh Zayid" and "الشيخ زايد" all give sheikh + zayed). An inverted
+index maps each term to the listings containing it; a query matches the
+listings that have every one of its terms and ranks them with BM25, title
+and location words counting more than description words. Writes append to
+the postings and mark the listing's earlier entries dead, so updates are
+cheap; the periodic rebuild drops the dead entries.
+"""
+import math
+import re
+import threading
+import unicodedata
+from array import array
+from functools import lru_cache
+from cache import LRUCache
+
+try:
+    import numpy as np
+except ImportError:  # Without NumPy, q= keeps using SQL LIKE
+    np = None
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Each word counts this many times towards a listing's term frequency and length
+FIELD_WEIGHTS = (('title', 3.0), ('location', 2.0), ('description', 1.0))
+
+STOP_WORDS = {
+    'a', 'an', 'and', 'at', 'by', 'for', 'from', 'in', 'is', 'near', 'of', 'on', 'or', 'the', 'to',
+    'with', 'el', 'al', 'في', 'من', 'علي', 'الي', 'مع', 'و',
+}
+
+# Canonical term -> other spellings of it, Latin transliterations and Arabic script alike
+ALIASES = {
+    'cairo': ['kahira', 'qahira', 'القاهرة'],
+    'giza': ['gizeh', 'geza', 'geeza', 'الجيزة'],
+    'alexandria': ['alex', 'iskandaria', 'iskandariya', 'eskendereya', 'الإسكندرية', 'اسكندرية'],
+    'sheikh': ['shaikh', 'sheik', 'shaykh', 'shekh', 'الشيخ'],
+    'zayed': ['zayid', 'zaid', 'zaied', 'زايد'],
+    'october': ['oktober', 'octobar', 'أكتوبر'],
+    '6': ['6th', 'sixth', 'السادس'],
+    '5': ['5th', 'fifth', 'khames', 'khamis', 'الخامس'],
+    'new': ['gedida', 'gadida', 'jadida', 'guedida', 'الجديدة'],
+    'city': ['madina', 'madinat', 'مدينة'],
+    'north': ['shamal', 'الشمالي', 'شمال'],
+    'coast': ['sahel', 'sa7el', 'الساحل'],
+    'maadi': ['maady', 'maadie', 'meadi', 'المعادي'],
+    'zamalek': ['zamalik', 'الزمالك'],
+    'heliopolis': ['هليوبوليس'],
+    'nasr': ['nasser', 'نصر'],
+    'mohandessin': ['mohandeseen', 'mohandiseen', 'muhandisin', 'المهندسين'],
+    'dokki': ['doqqi', 'duqqi', 'dokky', 'الدقي'],
+    'katameya': ['kattameya', 'qattamia', 'katamya', 'qatameya', 'القطامية'],
+    'tagamoa': ['tagamo3', 'tagamu', 'tagammu', 'tagamo', 'التجمع'],
+    'rehab': ['rihab', 'الرحاب'],
+    'madinaty': ['madinati', 'مدينتي'],
+    'shorouk': ['shrouk', 'shorook', 'shurouk', 'الشروق'],
+    'obour': ['obor', 'ubur', 'العبور'],
+    'mokattam': ['moqattam', 'muqattam', 'mokatam', 'المقطم'],
+    'sokhna': ['sukhna', 'sokna', 'السخنة'],
+    'hurghada': ['ghardaka', 'ghardaqa', 'hurgada', 'الغردقة'],
+    'sharm': ['شرم'],
+    'gouna': ['guna', 'jouna', 'الجونة'],
+    'capital': ['asema', 'العاصمة'],
+    'pyramids': ['haram', 'ahram', 'الهرم', 'الأهرام'],
+    'downtown': ['wust', 'wist', 'balad', 'وسط'],
+    'apartment': ['flat', 'shaqa', 'sha2a', 'شقة'],
+    'villa': ['fila', 'فيلا', 'فيللا'],
+    'townhouse': ['town-house', 'تاون'],
+    'land': ['ard', 'أرض'],
+    'commercial': ['tugari', 'tijari', 'تجاري'],
+    'office': ['maktab', 'مكتب'],
+    'shop': ['mahal', 'محل'],
+    'chalet': ['shalih', 'شاليه'],
+    'duplex': ['dublex', 'دوبلكس'],
+    'penthouse': ['بنتهاوس'],
+    'studio': ['ستوديو', 'استوديو'],
+    'garden': ['hadika', 'حديقة'],
+}
+
+_WORD = re.compile(r'[0-9a-zء-ي]+')
+# Letter variants written interchangeably, the elongation stroke, and Arabic-Indic digits
+_ARABIC_FOLDS = str.maketrans({'ٱ': 'ا', 'ة': 'ه', 'ى': 'ي', 'ـ': None,
+                               **{chr(0x0660 + digit): str(digit) for digit in range(10)}})
+
+
+def _normalize(text):
+    """Lower-case text without Latin accents, Arabic vowel marks or hamza seats"""
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(char for char in text if not unicodedata.combining(char)).lower().translate(_ARABIC_FOLDS)
+
+
+def _fold(word):
+    """Spelling-insensitive key of one normalized word"""
+    if 'ء' <= word[0] <= 'ي':
+        # Arabic: drop the definite article
+        if word.startswith('ال') and len(word) > 3:
+            word = word[2:]
+        return word
+    # English plurals, then the vowel and consonant spellings transliterations vary on
+    if len(word) > 4 and word.endswith('ies'):
+        word = word[:-3] + 'y'
+    elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        word = word[:-1]
+    word = word.replace('q', 'k').replace('ou', 'o').replace('ee', 'i')
+    word = re.sub(r'([a-z])\1+', r'\1', word)
+    if len(word) > 3 and word.endswith('y'):
+        word = word[:-1] + 'i'
+    return word
+
+
+def _build_aliases():
+    aliases = {}
+    for term, spellings in ALIASES.items():
+        for spelling in [term] + spellings:
+            for word in _WORD.findall(_normalize(spelling)):
+                aliases[_fold(word)] = term
+    return aliases
+
+
+_ALIASES = _build_aliases()
+
+
+@lru_cache(maxsize=65536)
+def _term(word):
+    return _ALIASES.get(_fold(word)) or _fold(word)
+
+
+def tokenize(text):
+    """Search terms of a piece of text, in order, with repeats"""
+    return [_term(word) for word in _WORD.findall(_normalize(text)) if word not in STOP_WORDS]
+
+
+def text_row(prop):
+    """The fields of a Property the index needs, as a picklable tuple"""
+    return (prop.id, prop.title, prop.description, prop.location, prop.status)
+
+
+def _weighted_terms(row):
+    """{term: weighted frequency} and weighted length of one text_row() listing"""
+    fields = dict(zip(('title', 'description', 'location'), row[1:4]))
+    counts = {}
+    length = 0.0
+    for name, weight in FIELD_WEIGHTS:
+        for term in tokenize(fields[name]):
+            counts[term] = counts.get(term, 0.0) + weight
+            length += weight
+    return counts, length
+
+
+class TextIndex:
+    """Inverted index of available listings, searched with BM25"""
+
+    def __init__(self, rows, memo_size=2000, memo_bytes=64 * 1024 * 1024):
+        self._lock = threading.RLock()
+        self._postings = {}         # term -> (array of slots, array of weighted frequencies)
+        self._ids = array('q')      # slot -> property id
+        self._lengths = array('f')  # slot -> weighted length
+        self._alive = bytearray()   # slot -> 1 while it is the listing's current entry
+        self._slots = {}            # property id -> current slot
+        self._total_length = 0.0
+        self._dead = 0
+        # Results per query, dropped whenever the index changes
+        self._memo = LRUCache('text_search', max_entries=memo_size, ttl=3600, max_bytes=memo_bytes)
+        for row in rows:
+            if row[4] == 'available':
+                self._put(row)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _put(self, row):
+        self._remove(row[0])
+        counts, length = _weighted_terms(row)
+        slot = len(self._ids)
+        self._ids.append(row[0])
+        self._lengths.append(length)
+        self._alive.append(1)
+        self._slots[row[0]] = slot
+        self._total_length += length
+        for term, frequency in counts.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = (array('i'), array('f'))
+            postings[0].append(slot)
+            postings[1].append(frequency)
+
+    def _remove(self, prop_id):
+        slot = self._slots.pop(prop_id, None)
+        if slot is not None:
+            self._alive[slot] = 0
+            self._total_length -= self._lengths[slot]
+            self._dead += 1
+
+    def upsert(self, rows):
+        """Add or refresh listings given as text_row() tuples; unavailable ones are removed"""
+        with self._lock:
+            for row in rows:
+                if row[4] == 'available':
+                    self._put(row)
+                else:
+                    self._remove(row[0])
+            self._memo.clear()
+
+    def remove(self, prop_ids):
+        with self._lock:
+            for prop_id in prop_ids:
+                self._remove(prop_id)
+            self._memo.clear()
+
+    def search(self, query):
+        """(ids, BM25 scores) as arrays of the listings containing every term of the query.
+
+        None when the query has no searchable words, so the caller can treat
+        it as no text filter at all.
+        """
+        terms = tuple(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return None
+        result = self._memo.get(terms)
+        if result is not None:
+            return result
+
+        generation = self._memo.generation
+        with self._lock:
+            count = len(self._slots)
+            postings = [self._postings.get(term) for term in terms]
+            if not count or any(entry is None for entry in postings):
+                result = (np.zeros(0, dtype=np.int64), np.zeros(0))
+            else:
+                alive = np.frombuffer(bytes(self._alive), dtype=bool)
+                # Copies, so later appends don't resize arrays a view still points at
+                postings = [(np.array(slots, dtype=np.int64), np.array(weights, dtype=np.float64))
+                            for slots, weights in postings]
+                postings.sort(key=lambda entry: len(entry[0]))
+                matches = postings[0][0][alive[postings[0][0]]]
+                for slots, weights in postings[1:]:
+                    matches = np.intersect1d(matches, slots, assume_unique=True)
+                lengths = np.array(self._lengths, dtype=np.float64)[matches]
+                average = self._total_length / count
+                norm = K1 * (1 - B + B * lengths / average)
+                scores = np.zeros(len(matches))
+                for slots, weights in postings:
+                    frequency = int(np.count_nonzero(alive[slots]))
+                    idf = math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+                    # Postings are in slot order, so each match's entry is found by bisection
+                    tf = weights[np.searchsorted(slots, matches)]
+                    scores += idf * tf * (K1 + 1) / (tf + norm)
+                result = (np.array(self._ids, dtype=np.int64)[matches], scores)
+        self._memo.set(terms, result, generation=generation)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'listings': len(self._slots), 'terms': len(self._postings), 'dead': self._dead,
+                    'postings': sum(len(slots) for slots, weights in self._postings.values()),
+                    'memo': self._memo.stats()}
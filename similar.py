@@ -0,0 +1,195 @@
+"""In-memory nearest-neighbour index behind Property.get_similar.
+
+Each available listing is a point in a small feature space: log price, log
+area, bedrooms, bathrooms and log price per square metre, each scaled by its
+spread across the whole catalogue, plus a penalty for being in another
+district or city. Neighbours are only looked for among listings of the same
+type. The index is built once from the database and then kept current by
+upsert()/remove() as listings are written.
+"""
+import threading
+from functools import lru_cache
+from cache import LRUCache
+
+try:
+    import numpy as np
+except ImportError:  # Without NumPy, get_similar keeps using its SQL query
+    np = None
+
+# Relative weight of each feature in the distance, in FEATURES order
+FEATURES = ('price', 'area', 'bedrooms', 'bathrooms', 'price_per_sqm')
+WEIGHTS = (1.0, 1.0, 0.5, 0.5, 1.0)
+# Added to the squared distance for a listing in another district, and again if in another city
+DISTRICT_PENALTY = 0.5
+CITY_PENALTY = 1.0
+
+
+def listing_row(prop):
+    """The fields of a Property the index needs, as a picklable tuple"""
+    return (prop.id, prop.property_type, prop.location, prop.price, prop.area,
+            prop.bedrooms, prop.bathrooms, prop.status)
+
+
+def _features(prices, areas, bedrooms, bathrooms):
+    """One row of FEATURES per listing, from parallel sequences of column values"""
+    def column(values):
+        return np.array([float(value or 0) for value in values])
+
+    price = np.maximum(column(prices), 0)
+    area = np.maximum(column(areas), 0)
+    per_sqm = np.divide(price, area, out=np.zeros_like(price), where=area > 0)
+    return np.column_stack([np.log1p(price), np.log1p(area), column(bedrooms), column(bathrooms),
+                            np.log1p(per_sqm)])
+
+
+@lru_cache(maxsize=4096)
+def _location_parts(location):
+    """(district, city) keys of a free-text location like 'Maadi, Cairo'"""
+    parts = [' '.join(part.split()).lower() for part in (location or '').split(',') if part.strip()]
+    if not parts:
+        return '', ''
+    return ', '.join(parts), parts[-1]
+
+
+class SimilarIndex:
+    """Feature arrays of available listings, searched by weighted distance"""
+
+    def __init__(self, rows, memo_size=5000):
+        self._lock = threading.RLock()
+        self._capacity = 0
+        self._size = 0
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._points = np.zeros((0, len(FEATURES)))
+        self._types = np.zeros(0, dtype=np.int32)
+        self._districts = np.zeros(0, dtype=np.int32)
+        self._cities = np.zeros(0, dtype=np.int32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._slots = {}        # property id -> row in the arrays
+        self._codes = {}        # type / district / city string -> int code
+        self._groups = {}       # type code -> rows of live listings of that type
+        # Results per listing, dropped whenever the index changes
+        self._memo = LRUCache('similar', max_entries=memo_size, ttl=3600)
+
+        rows = [row for row in rows if row[7] == 'available']
+        self._grow(len(rows))
+        if rows:
+            ids, types, locations, prices, areas, bedrooms, bathrooms, _ = zip(*rows)
+            size = self._size = len(rows)
+            self._slots = dict(zip(ids, range(size)))
+            self._ids[:size] = ids
+            self._points[:size] = _features(prices, areas, bedrooms, bathrooms)
+            self._types[:size] = [self._code(('type', value)) for value in types]
+            parts = [_location_parts(location) for location in locations]
+            self._districts[:size] = [self._code(('district', district)) for district, city in parts]
+            self._cities[:size] = [self._code(('city', city)) for district, city in parts]
+            self._alive[:size] = True
+        live = self._points[:self._size]
+        # Spread of each feature over the catalogue; a constant feature gets a unit scale
+        spread = live.std(axis=0) if self._size else np.ones(len(FEATURES))
+        spread[spread == 0] = 1.0
+        self._weights = np.asarray(WEIGHTS) / spread ** 2
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _code(self, value):
+        return self._codes.setdefault(value, len(self._codes))
+
+    def _grow(self, needed):
+        if needed <= self._capacity:
+            return
+        capacity = max(needed, self._capacity * 2, 1024)
+        extra = capacity - self._capacity
+        self._ids = np.concatenate([self._ids, np.zeros(extra, dtype=np.int64)])
+        self._points = np.concatenate([self._points, np.zeros((extra, len(FEATURES)))])
+        self._types = np.concatenate([self._types, np.zeros(extra, dtype=np.int32)])
+        self._districts = np.concatenate([self._districts, np.zeros(extra, dtype=np.int32)])
+        self._cities = np.concatenate([self._cities, np.zeros(extra, dtype=np.int32)])
+        self._alive = np.concatenate([self._alive, np.zeros(extra, dtype=bool)])
+        self._capacity = capacity
+
+    def _put(self, row):
+        prop_id, property_type, location, price, area, bedrooms, bathrooms, status = row
+        slot = self._slots.get(prop_id)
+        if slot is None:
+            self._grow(self._size + 1)
+            slot = self._size
+            self._size += 1
+            self._slots[prop_id] = slot
+        else:
+            self._groups.pop(int(self._types[slot]), None)
+        district, city = _location_parts(location)
+        self._ids[slot] = prop_id
+        self._points[slot] = _features([price], [area], [bedrooms], [bathrooms])[0]
+        self._types[slot] = self._code(('type', property_type))
+        self._districts[slot] = self._code(('district', district))
+        self._cities[slot] = self._code(('city', city))
+        self._alive[slot] = True
+        self._groups.pop(int(self._types[slot]), None)
+
+    def upsert(self, rows):
+        """Add or refresh listings given as listing_row() tuples; unavailable ones are removed"""
+        with self._lock:
+            for row in rows:
+                if row[7] == 'available':
+                    self._put(row)
+                else:
+                    self._remove(row[0])
+            self._memo.clear()
+
+    def remove(self, prop_ids):
+        with self._lock:
+            for prop_id in prop_ids:
+                self._remove(prop_id)
+            self._memo.clear()
+
+    def _remove(self, prop_id):
+        slot = self._slots.pop(prop_id, None)
+        if slot is not None:
+            self._alive[slot] = False
+            self._groups.pop(int(self._types[slot]), None)
+
+    def _group(self, type_code):
+        rows = self._groups.get(type_code)
+        if rows is None:
+            size = self._size
+            rows = np.flatnonzero(self._alive[:size] & (self._types[:size] == type_code))
+            self._groups[type_code] = rows
+        return rows
+
+    def similar(self, row, k=3):
+        """Ids of the k listings nearest to the listing in `row` (a listing_row() tuple), nearest first"""
+        memo_key = (row, k)
+        ids = self._memo.get(memo_key)
+        if ids is not None:
+            return list(ids)
+
+        generation = self._memo.generation
+        prop_id, property_type, location, price, area, bedrooms, bathrooms, status = row
+        district, city = _location_parts(location)
+        with self._lock:
+            type_code = self._codes.get(('type', property_type))
+            if type_code is None:
+                return []
+            rows = self._group(type_code)
+            rows = rows[self._ids[rows] != prop_id]
+            if not len(rows):
+                return []
+            point = _features([price], [area], [bedrooms], [bathrooms])[0]
+            distance = ((self._points[rows] - point) ** 2) @ self._weights
+            distance += np.where(self._cities[rows] == self._codes.get(('city', city), -1), 0.0, CITY_PENALTY)
+            distance += np.where(self._districts[rows] == self._codes.get(('district', district), -1),
+                                 0.0, DISTRICT_PENALTY)
+            if len(rows) > k:
+                nearest = np.argpartition(distance, k)[:k]
+            else:
+                nearest = np.arange(len(rows))
+            nearest = nearest[np.argsort(distance[nearest], kind='stable')]
+            ids = tuple(int(prop) for prop in self._ids[rows[nearest]])
+        self._memo.set(memo_key, ids, generation=generation)
+        return list(ids)
+
+    def stats(self):
+        with self._lock:
+            return {'listings': len(self._slots), 'slots': self._size, 'capacity': self._capacity,
+                    'memo': self._memo.stats()}
@@ -1,30 +1,80 @@
 /* eslint-disable */
 // Favorites functionality
+// Logged-in visitors get favorite state rendered with the page and saved on the server;
+// anonymous visitors keep theirs in localStorage
+const csrfMeta = document.querySelector('meta[name="csrf-token"]');
 let favorites = JSON.parse(localStorage.getItem('propertyFavorites')) || [];
 
+function setFavoriteState(propertyId, favorited) {
+    document.querySelectorAll(`[data-property-id="${propertyId}"] .property-favorite`).forEach(btn => {
+        btn.classList.toggle('favorited', favorited);
+        btn.dataset.favoriteState = favorited ? 'on' : 'off';
+        const icon = btn.querySelector('i');
+        if (icon) {
+            icon.classList.toggle('fas', favorited);
+            icon.classList.toggle('far', !favorited);
+        }
+    });
+}
+
 function toggleFavorite(propertyId) {
-    const index = favorites.indexOf(propertyId);
-    const favoriteBtn = document.querySelector(`[data-property-id="${propertyId}"] .property-favorite`);
+    if (csrfMeta) {
+        fetch(`/toggle-favorite/${propertyId}`, {
+            method: 'POST',
+            headers: {
+                'X-CSRFToken': csrfMeta.content
+            }
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (data.success) {
+                setFavoriteState(propertyId, data.is_favorited);
+            }
+        })
+        .catch(error => console.error('Error toggling favorite:', error));
+        return;
+    }
 
+    const index = favorites.indexOf(propertyId);
     if (index > -1) {
         favorites.splice(index, 1);
-        favoriteBtn.classList.remove('favorited');
     } else {
         favorites.push(propertyId);
-        favoriteBtn.classList.add('favorited');
     }
-
+    setFavoriteState(propertyId, index === -1);
     localStorage.setItem('propertyFavorites', JSON.stringify(favorites));
 }
 
-// Initialize favorites on page load
-document.addEventListener('DOMContentLoaded', function() {
-    favorites.forEach(propertyId => {
-        const favoriteBtn = document.querySelector(`[data-property-id="${propertyId}"] .property-favorite`);
-        if (favoriteBtn) {
-            favoriteBtn.classList.add('favorited');
+// Look up favorite state in one request for cards rendered without it
+function loadFavoriteStatus(root = document) {
+    const ids = new Set();
+    root.querySelectorAll('[data-property-id]').forEach(card => {
+        const btn = card.querySelector('.property-favorite');
+        if (btn && !btn.dataset.favoriteState) {
+            ids.add(card.dataset.propertyId);
         }
     });
+    if (!csrfMeta || ids.size === 0) {
+        return;
+    }
+
+    fetch(`/favorites/status?ids=${Array.from(ids).join(',')}`)
+    .then(response => response.json())
+    .then(data => {
+        Object.entries(data.favorites || {}).forEach(([propertyId, favorited]) => {
+            setFavoriteState(propertyId, favorited);
+        });
+    })
+    .catch(error => console.error('Error loading favorite status:', error));
+}
+
+// Initialize favorites on page load
+document.addEventListener('DOMContentLoaded', function() {
+    if (csrfMeta) {
+        loadFavoriteStatus();
+    } else {
+        favorites.forEach(propertyId => setFavoriteState(propertyId, true));
+    }
 });
 
 // View toggle functionality
@@ -47,83 +97,60 @@ function setView(viewType, buttonElement) {
 
 
 
-// Filter functionality
-function applyFilters() {
-    const propertyType = document.getElementById('propertyType').value;
-    const location = document.getElementById('location').value;
-    const priceRange = document.getElementById('priceRange').value;
+// Filters and sorting run on the server over every listing; these rebuild the query
+// string and reload, starting again from the first page
+const FILTER_PARAMS = ['q', 'type', 'location', 'location_id', 'min_price', 'max_price', 'min_area', 'max_area', 'bedrooms', 'bathrooms'];
 
-    const propertyCards = document.querySelectorAll('.property-card');
-
-    propertyCards.forEach(card => {
-        let show = true;
-
-        // Property type filter
-        if (propertyType && !card.querySelector('.property-title').textContent.toLowerCase().includes(propertyType.toLowerCase())) {
-            show = false;
+function listingUrl(changes) {
+    const params = new URLSearchParams(window.location.search);
+    params.delete('page');
+    params.delete('cursor');
+    Object.entries(changes).forEach(([key, value]) => {
+        if (value) {
+            params.set(key, value);
+        } else {
+            params.delete(key);
         }
-
-        // Location filter
-        if (location && !card.querySelector('.property-location').textContent.includes(location)) {
-            show = false;
-        }
-
-        // Price range filter (simplified - would need actual price data)
-        if (priceRange) {
-            // This would need to be implemented based on actual property data
-            // For now, just show all
-        }
-
-        card.style.display = show ? 'block' : 'none';
     });
+    const query = params.toString();
+    return window.location.pathname + (query ? '?' + query : '');
 }
 
-// Sort functionality
-function sortProperties() {
-    const sortBy = document.getElementById('sortBy').value;
-    const grid = document.getElementById('propertiesGrid');
-    const cards = Array.from(grid.children);
-
-    cards.sort((a, b) => {
-        switch (sortBy) {
-            case 'price-low':
-                return getPrice(a) - getPrice(b);
-            case 'price-high':
-                return getPrice(b) - getPrice(a);
-            case 'newest':
-                return 0; // Would need date data
-            case 'oldest':
-                return 0; // Would need date data
-            case 'area':
-                return getArea(b) - getArea(a);
-            default:
-                return 0;
-        }
-    });
-
-    cards.forEach(card => grid.appendChild(card));
+// "min-max" option values; either end may be empty
+function rangeParams(value, minKey, maxKey) {
+    const [min = '', max = ''] = (value || '').split('-');
+    return { [minKey]: min, [maxKey]: max };
 }
 
-function getPrice(card) {
-    const priceText = card.querySelector('.property-price').textContent;
-    const match = priceText.match(/[\d,]+/);
-    return match ? parseInt(match[0].replace(/,/g, '')) : 0;
+function applyFilters() {
+    showLoading();
+    window.location.href = listingUrl({
+        q: document.getElementById('searchQuery').value.trim(),
+        type: document.getElementById('propertyType').value,
+        // The dropdown picks a place by id; a free-text location from an older link is dropped
+        location: '',
+        location_id: document.getElementById('location').value,
+        ...rangeParams(document.getElementById('priceRange').value, 'min_price', 'max_price'),
+        ...rangeParams(document.getElementById('areaRange').value, 'min_area', 'max_area'),
+        bedrooms: document.getElementById('bedrooms').value,
+        bathrooms: document.getElementById('bathrooms').value
+    });
 }
 
-function getArea(card) {
-    const areaText = card.querySelector('.property-feature:last-child').textContent;
-    const match = areaText.match(/(\d+)/);
-    return match ? parseInt(match[1]) : 0;
+function sortProperties() {
+    const sortBy = document.getElementById('sortBy').value;
+    // Searches are ranked by relevance unless another order is asked for
+    const defaultSort = new URLSearchParams(window.location.search).get('q') ? 'relevance' : 'newest';
+    showLoading();
+    window.location.href = listingUrl({ sort: sortBy === defaultSort ? '' : sortBy });
 }
 
 // Clear filters
 function clearFilters() {
-    document.getElementById('propertyType').value = '';
-    document.getElementById('location').value = '';
-    document.getElementById('priceRange').value = '';
-
-    const propertyCards = document.querySelectorAll('.property-card');
-    propertyCards.forEach(card => card.style.display = 'block');
+    const changes = {};
+    FILTER_PARAMS.forEach(key => changes[key] = '');
+    showLoading();
+    window.location.href = listingUrl(changes);
 }
 
 // Loading overlay
@@ -134,3 +161,6 @@ function showLoading() {
 function hideLoading() {
     document.getElementById('loadingOverlay').style.display = 'none';
 }
+
+// A page restored from the back/forward cache still shows the overlay from leaving it
+window.addEventListener('pageshow', hideLoading);